@@ -0,0 +1,244 @@
+"""
+Measure replication ingest and changeset queries against a local mongod, at growing numbers of changesets.
+
+For each size, synthetic replication diffs are parsed with ChangesetParser, written through
+ChangesetIngestBuffer, then queried by tags like /api/changesets does, without the user info lookups.
+The results are saved as JSON together with the git commit, and can be compared with an earlier run.
+
+The database is dropped before each size, so use a dedicated one (the default name is refused):
+
+    MONGO_DB_NAME=osm-thanos-benchmark python -m benchmarks.changesets_mongo
+        [--sizes N ...] [--per-diff N] [--rounds N] [--seed N] [--output FILE.json] [--compare FILE.json]
+"""
+
+import argparse
+import platform
+import statistics
+import subprocess
+import time
+from contextlib import aclosing
+from datetime import UTC, datetime, timedelta
+from functools import partial
+from pathlib import Path
+
+import anyio
+import orjson
+
+from benchmarks.generator import CHANGESETS_PER_DAY, FIRST_CHANGESET_ID, START_DATE, generate_replication_diffs
+from benchmarks.replication_parse import parse_streaming
+from changeset_buckets import drop_expired_buckets
+from changeset_buffer import ChangesetIngestBuffer
+from changeset_migration import migrate_changesets
+from config import CHANGESETS_PAGE_SIZE, NAME, REPLICATION_FLUSH_SIZE
+from config_db import MONGO_CLIENT, MONGO_DB_NAME, setup_mongo
+from filter import iter_changeset_docs
+
+_DAY = timedelta(days=1)
+
+# (name, tags), from the most common to the rarest match
+_QUERIES = (
+    ('any', ()),
+    ('editor', ('created_by=iD 2.27.3',)),
+    ('key', ('imagery_used',)),
+    ('hashtag', ('hashtags=#missingmaps',)),
+    ('rare_pair', ('review_requested=yes', 'created_by=StreetComplete 56.1')),
+    ('empty', ('__empty__',)),
+)
+
+
+def _git_commit() -> str | None:
+    try:
+        output = subprocess.check_output(('git', 'rev-parse', 'HEAD'), text=True, stderr=subprocess.DEVNULL)  # noqa: S607
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return output.strip()
+
+
+def _summarize(seconds: list[float]) -> dict:
+    ordered = sorted(seconds)
+    return {
+        'min_ms': ordered[0] * 1000,
+        'median_ms': statistics.median(ordered) * 1000,
+        'p95_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+
+
+async def _reset_database() -> None:
+    # through the buckets module first, which remembers the buckets it has indexed
+    await drop_expired_buckets(datetime.max)
+    await MONGO_CLIENT.drop_database(MONGO_DB_NAME)
+    await setup_mongo()
+    await migrate_changesets()
+
+
+async def _ingest(size: int, *, per_diff: int, seed: int) -> dict:
+    buffer = await ChangesetIngestBuffer.create()
+    compressed_bytes = 0
+    parse_seconds = 0
+    write_seconds = 0
+    kept = 0
+    pending = 0
+
+    async def flush() -> None:
+        nonlocal write_seconds, pending
+        ts = time.perf_counter()
+        await buffer.flush()
+        write_seconds += time.perf_counter() - ts
+        pending = 0
+
+    # generating the diffs is not measured
+    for repl_id, diff in enumerate(generate_replication_diffs(size, per_diff=per_diff, seed=seed), 1):
+        ts = time.perf_counter()
+        changesets = parse_streaming(diff)
+        parse_seconds += time.perf_counter() - ts
+
+        compressed_bytes += len(diff)
+        kept += len(changesets)
+        pending += len(changesets)
+        buffer.add(repl_id, changesets)
+
+        # flush by size only, the flush interval would depend on the generator speed
+        if pending >= REPLICATION_FLUSH_SIZE:
+            await flush()
+
+    await flush()
+
+    return {
+        'parse': {
+            'seconds': parse_seconds,
+            'changesets_per_second': size / parse_seconds,
+            'mib_per_second': compressed_bytes / 1024 / 1024 / parse_seconds,
+        },
+        'write': {
+            'seconds': write_seconds,
+            'changesets': kept,
+            'changesets_per_second': kept / write_seconds,
+        },
+    }
+
+
+async def _query_page(from_: datetime, to: datetime, tags: tuple[str, ...], after: int) -> tuple[float, int]:
+    count = 0
+    ts = time.perf_counter()
+
+    async with aclosing(iter_changeset_docs(from_, to, tags, after)) as docs:
+        async for _ in docs:
+            count += 1
+
+            if count == CHANGESETS_PAGE_SIZE:
+                break
+
+    return time.perf_counter() - ts, count
+
+
+async def _query(size: int, *, rounds: int) -> dict:
+    end = START_DATE + _DAY * size / CHANGESETS_PER_DAY
+    ranges = (('last_day', end - _DAY, end), ('all', START_DATE, end))
+    result = {}
+
+    for query_name, tags in _QUERIES:
+        for range_name, from_, to in ranges:
+            # the first page, and a page from the middle of the range, reached with `after`
+            middle_id = FIRST_CHANGESET_ID + int((from_ + (to - from_) / 2 - START_DATE) / _DAY * CHANGESETS_PER_DAY)
+            pages = (('first', 0), ('middle', middle_id))
+
+            for page_name, after in pages:
+                timings = []
+
+                for _ in range(rounds):
+                    seconds, count = await _query_page(from_, to, tags, after)
+                    timings.append(seconds)
+
+                result[f'{query_name}/{range_name}/{page_name}'] = {'changesets': count, **_summarize(timings)}
+
+    return result
+
+
+async def _run(sizes: list[int], *, per_diff: int, rounds: int, seed: int) -> dict:
+    server_info = await MONGO_CLIENT.server_info()
+    results = {}
+
+    for size in sizes:
+        print(f'{size} changesets: generating, parsing and writing...')
+        await _reset_database()
+        ingest = await _ingest(size, per_diff=per_diff, seed=seed)
+        parse, write = ingest['parse'], ingest['write']
+        print(f'  parse  {parse["changesets_per_second"]:10.0f} changesets/s  {parse["mib_per_second"]:7.2f} MiB/s')
+        print(f'  write  {write["changesets_per_second"]:10.0f} changesets/s  ({write["changesets"]} kept)')
+
+        query = await _query(size, rounds=rounds)
+
+        for name, stats in query.items():
+            print(f'  {name:30} {stats["median_ms"]:9.1f} ms median  {stats["p95_ms"]:9.1f} ms p95')
+
+        results[str(size)] = {**ingest, 'query': query}
+
+    await drop_expired_buckets(datetime.max)
+    await MONGO_CLIENT.drop_database(MONGO_DB_NAME)
+    return {'mongo': server_info['version'], 'results': results}
+
+
+def _flatten(value: dict, prefix: str = '') -> dict[str, float]:
+    result = {}
+
+    for key, item in value.items():
+        if isinstance(item, dict):
+            result.update(_flatten(item, f'{prefix}{key}.'))
+        else:
+            result[f'{prefix}{key}'] = item
+
+    return result
+
+
+def _compare(baseline: dict, current: dict) -> None:
+    print(f'Compared with {baseline["commit"]}:')
+    baseline_values = _flatten(baseline['results'])
+
+    for key, value in _flatten(current['results']).items():
+        base = baseline_values.get(key)
+
+        # counts and totals are not comparable, rates and latencies are
+        if not base or not key.endswith(('_per_second', '_ms')):
+            continue
+
+        # positive means better
+        change = (value / base - 1) if key.endswith('_per_second') else (base / value - 1)
+        print(f'  {key:60} {base:12.1f} -> {value:12.1f}  {change:+7.1%}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000, 10_000_000])
+    parser.add_argument('--per-diff', type=int, default=1000, help='changesets per replication diff')
+    parser.add_argument('--rounds', type=int, default=10, help='timing rounds per query')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', type=Path, help='results file, named after the git commit by default')
+    parser.add_argument('--compare', type=Path, help='results file of an earlier run')
+    args = parser.parse_args()
+
+    if MONGO_DB_NAME == NAME:
+        parser.error(f'The benchmark drops its database: set MONGO_DB_NAME to something else than {NAME!r}')
+
+    commit = _git_commit()
+    started_at = datetime.now(UTC)
+    run = partial(_run, args.sizes, per_diff=args.per_diff, rounds=args.rounds, seed=args.seed)
+    report = {
+        'commit': commit,
+        'started_at': started_at.isoformat(),
+        'python': platform.python_version(),
+        'parameters': {'per_diff': args.per_diff, 'rounds': args.rounds, 'seed': args.seed},
+        **anyio.run(run),
+    }
+
+    output = args.output or Path(f'changesets_mongo-{(commit or "unknown")[:8]}.json')
+    output.write_bytes(orjson.dumps(report, option=orjson.OPT_INDENT_2))
+    print(f'Saved results to {output}')
+
+    if args.compare:
+        _compare(orjson.loads(args.compare.read_bytes()), report)
+
+
+if __name__ == '__main__':
+    main()
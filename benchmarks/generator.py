@@ -0,0 +1,183 @@
+"""
+Synthetic replication diffs, shaped like the ones published at planet.openstreetmap.org/replication/changesets.
+
+Changeset ids and closed_at dates grow from one diff to the next, like in the real feed. Tags follow rough
+real-world frequencies: most changesets come from a few editors, comments and sources repeat, and a long tail
+of keys and values is rare. Some changesets are still open, commented or empty, so that the parsers skip them.
+The output only depends on the seed.
+"""
+
+import gzip
+import random
+from collections.abc import Iterator
+from datetime import UTC, datetime, timedelta
+from functools import lru_cache
+from xml.sax.saxutils import quoteattr
+
+FIRST_CHANGESET_ID = 140_000_000
+START_DATE = datetime(2024, 1, 1, tzinfo=UTC)
+CHANGESETS_PER_DAY = 100_000
+
+# (created_by, weight, extra tags of that editor with their probabilities)
+_EDITORS = (
+    ('iD 2.27.3', 45, (('imagery_used', 0.8), ('locale', 1), ('host', 1), ('changesets_count', 1))),
+    ('JOSM/1.5 (18907 en)', 15, (('source', 0.5), ('imagery_used', 0.2))),
+    ('StreetComplete 56.1', 15, (('StreetComplete:quest_type', 1), ('source', 1), ('locale', 1))),
+    ('Every Door Android 5.0', 6, (('locale', 1), ('source', 0.3))),
+    ('Organic Maps android 2024.01.09-6', 5, (('bot', 0.01),)),
+    ('OsmAnd~ 4.6.11', 4, (('source', 0.2),)),
+    ('Vespucci 19.0.2.0', 3, (('source', 0.5), ('imagery_used', 0.5))),
+    ('RapiD 2.2.4', 2, (('imagery_used', 1), ('locale', 1), ('host', 1), ('changesets_count', 1))),
+    ('MAPS.ME android 14.0.71063', 2, ()),
+    ('Potlatch 2.0', 1, (('source', 0.3),)),
+    ('osmtools 0.1', 1, (('bot', 0.5), ('mechanical', 0.5))),
+    ('Go Map!! 4.2.0', 1, (('imagery_used', 0.3), ('locale', 1))),
+)
+_EDITOR_WEIGHTS = tuple(weight for _, weight, _ in _EDITORS)
+
+_COMMENTS = (
+    'Added buildings',
+    'Fixed roads',
+    'Survey',
+    'Added address',
+    'Update',
+    'Added opening hours',
+    'Fixed geometry',
+    'Added shops',
+    'Traced from imagery',
+    'Changed surface',
+)
+_COMMENT_WEIGHTS = (20, 15, 12, 10, 10, 8, 8, 7, 6, 4)
+
+_HASHTAGS = ('#mapathon', '#hotosm-project-15231', '#missingmaps', '#youthmappers', '#MapRoulette', '#osmus')
+_HASHTAG_WEIGHTS = (30, 25, 20, 12, 8, 5)
+
+# tags repeat a lot, escaping is the slowest part of the generator
+_quoteattr = lru_cache(maxsize=4096)(quoteattr)
+
+_TAG_VALUES = {
+    'imagery_used': (('Bing Maps Aerial', 50), ('Esri World Imagery', 30), ('Mapbox Satellite', 15), ('Custom', 5)),
+    'source': (('survey', 50), ('Bing', 20), ('local knowledge', 15), ('GPS', 10), ('Mapillary', 5)),
+    'locale': (('en', 40), ('de', 20), ('fr', 10), ('es', 10), ('pl', 10), ('ru', 10)),
+    'host': (('https://www.openstreetmap.org/edit', 90), ('https://rapideditor.org/edit', 10)),
+    'StreetComplete:quest_type': (
+        ('AddBuildingLevels', 30),
+        ('AddRoadSurface', 25),
+        ('AddOpeningHours', 20),
+        ('AddHousenumber', 25),
+    ),
+    'bot': (('yes', 1),),
+    'mechanical': (('yes', 1),),
+}
+
+
+def _choice(rng: random.Random, values: tuple[tuple[str, int], ...]) -> str:
+    return rng.choices([value for value, _ in values], [weight for _, weight in values])[0]
+
+
+def _generate_tags(rng: random.Random) -> dict[str, str]:
+    # a few changesets, mostly from old or broken editors, have no tags at all
+    if rng.random() < 0.02:
+        return {}
+
+    created_by, _, extra_tags = rng.choices(_EDITORS, _EDITOR_WEIGHTS)[0]
+    tags = {'created_by': created_by}
+
+    if rng.random() < 0.95:
+        # a long tail of unique comments
+        if rng.random() < 0.3:
+            tags['comment'] = f'Edited area #{rng.randrange(1_000_000)}'
+        else:
+            tags['comment'] = rng.choices(_COMMENTS, _COMMENT_WEIGHTS)[0]
+
+    for key, probability in extra_tags:
+        if rng.random() >= probability:
+            continue
+
+        if key == 'changesets_count':
+            tags[key] = str(int(rng.paretovariate(0.5)))
+        else:
+            tags[key] = _choice(rng, _TAG_VALUES[key])
+
+    if rng.random() < 0.1:
+        hashtags = rng.choices(_HASHTAGS, _HASHTAG_WEIGHTS)[0]
+        tags['hashtags'] = hashtags
+        tags['comment'] = f'{tags.get("comment", "")} {hashtags}'.strip()
+
+    if rng.random() < 0.02:
+        tags['review_requested'] = 'yes'
+
+    return tags
+
+
+def _format_date(dt: datetime) -> str:
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def generate_replication_diff(
+    num_changesets: int,
+    *,
+    seed: int = 42,
+    first_id: int = FIRST_CHANGESET_ID,
+    start: datetime = START_DATE,
+    duration: timedelta = timedelta(days=1),
+) -> bytes:
+    """Return a gzipped diff of changesets with consecutive ids, closed within `duration` after `start`."""
+    rng = random.Random(seed)  # noqa: S311
+    lines = ['<?xml version="1.0" encoding="UTF-8"?>', '<osm version="0.6" generator="replicate_changesets.rb">']
+    step = duration / max(num_changesets, 1)
+
+    for i in range(num_changesets):
+        closed_at = start + step * i
+        created_at = closed_at - timedelta(seconds=int(rng.expovariate(1 / 600)))
+        is_open = rng.random() < 0.1
+        attrs = {
+            'id': str(first_id + i),
+            'created_at': _format_date(created_at),
+            'open': 'true' if is_open else 'false',
+            'comments_count': '1' if rng.random() < 0.05 else '0',
+            'num_changes': str(int(rng.paretovariate(0.8)) if rng.random() < 0.95 else 0),
+            'user': f'user_{rng.randrange(50_000)}',
+            'uid': str(rng.randrange(20_000_000)),
+            'min_lat': f'{rng.uniform(-90, 90):.7f}',
+            'min_lon': f'{rng.uniform(-180, 180):.7f}',
+            'max_lat': f'{rng.uniform(-90, 90):.7f}',
+            'max_lon': f'{rng.uniform(-180, 180):.7f}',
+        }
+
+        if not is_open:
+            attrs['closed_at'] = _format_date(closed_at)
+
+        # attribute values never need escaping
+        attrs_str = ' '.join(f'{k}="{v}"' for k, v in attrs.items())
+
+        if tags := _generate_tags(rng):
+            lines.append(f'  <changeset {attrs_str}>')
+            lines.extend(f'    <tag k={_quoteattr(k)} v={_quoteattr(v)}/>' for k, v in tags.items())
+            lines.append('  </changeset>')
+        else:
+            lines.append(f'  <changeset {attrs_str}/>')
+
+    lines.append('</osm>')
+    # the gzip command line default, faster than the module default for large suites
+    return gzip.compress('\n'.join(lines).encode(), compresslevel=6)
+
+
+def generate_replication_diffs(
+    num_changesets: int,
+    *,
+    per_diff: int = 1000,
+    seed: int = 42,
+    changesets_per_day: int = CHANGESETS_PER_DAY,
+) -> Iterator[bytes]:
+    """Yield consecutive gzipped diffs of `per_diff` changesets each, `num_changesets` in total."""
+    duration = timedelta(days=per_diff / changesets_per_day)
+
+    for i, offset in enumerate(range(0, num_changesets, per_diff)):
+        yield generate_replication_diff(
+            min(per_diff, num_changesets - offset),
+            seed=seed + i,
+            first_id=FIRST_CHANGESET_ID + offset,
+            start=START_DATE + duration * i,
+            duration=duration,
+        )
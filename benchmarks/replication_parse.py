@@ -0,0 +1,101 @@
+"""
+Compare the legacy xmltodict replication parser against the streaming ChangesetParser.
+
+Usage: python -m benchmarks.replication_parse [--changesets N] [--rounds N] [FILE.osm.gz ...]
+"""
+
+import argparse
+import gzip
+import time
+import tracemalloc
+import zlib
+from collections.abc import Callable
+from pathlib import Path
+
+import xmltodict
+
+from benchmarks.generator import generate_replication_diff
+from changeset_parser import ChangesetParser
+from changeset_schema import legacy_to_compact
+from xmltodict_postprocessor import xmltodict_postprocessor
+
+_CHUNK_SIZE = 64 * 1024
+
+
+def parse_legacy(compressed: bytes) -> list[dict]:
+    xml = gzip.decompress(compressed).decode()
+    json = xmltodict.parse(
+        xml,
+        postprocessor=xmltodict_postprocessor,
+        force_list=('changeset', 'action', 'node', 'way', 'relation', 'member', 'tag', 'nd'),
+    )
+
+    changesets = json['osm'].get('changeset', [])
+    changesets = [c for c in changesets if c['@comments_count'] == 0 and c['@num_changes'] > 0 and not c['@open']]
+
+    for c in changesets:
+        if 'tag' in c:
+            c['tags'] = {tag['@k']: tag['@v'] for tag in c['tag']}
+            del c['tag']
+        else:
+            c['tags'] = {'__empty__': '1'}
+
+    return changesets
+
+
+def parse_streaming(compressed: bytes) -> list[dict]:
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    parser = ChangesetParser()
+    changesets = []
+
+    for i in range(0, len(compressed), _CHUNK_SIZE):
+        changesets.extend(parser.feed(decompressor.decompress(compressed[i : i + _CHUNK_SIZE])))
+
+    changesets.extend(parser.feed(decompressor.flush()))
+    changesets.extend(parser.close())
+    return changesets
+
+
+def _measure(func: Callable[[bytes], list[dict]], data: bytes, rounds: int) -> tuple[float, int]:
+    best = float('inf')
+
+    for _ in range(rounds):
+        ts = time.perf_counter()
+        func(data)
+        best = min(best, time.perf_counter() - ts)
+
+    tracemalloc.start()
+    func(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--changesets', type=int, default=5000, help='synthetic changesets per diff')
+    parser.add_argument('--rounds', type=int, default=5, help='timing rounds, the best one is reported')
+    parser.add_argument('files', nargs='*', type=Path, help='real replication diffs to use instead')
+    args = parser.parse_args()
+
+    if args.files:
+        inputs = [(path.name, path.read_bytes()) for path in args.files]
+    else:
+        inputs = [(f'synthetic-{args.changesets}', generate_replication_diff(args.changesets))]
+
+    for name, data in inputs:
+        legacy, streaming = parse_legacy(data), parse_streaming(data)
+        assert [legacy_to_compact(c) for c in legacy] == streaming, f'{name}: parsers disagree'
+
+        legacy_time, legacy_peak = _measure(parse_legacy, data, args.rounds)
+        streaming_time, streaming_peak = _measure(parse_streaming, data, args.rounds)
+
+        print(f'{name}: {len(data) / 1024:.0f} KiB compressed, {len(streaming)} changesets kept')
+        print(f'  legacy    {legacy_time * 1000:8.1f} ms  peak {legacy_peak / 1024 / 1024:7.2f} MiB')
+        print(f'  streaming {streaming_time * 1000:8.1f} ms  peak {streaming_peak / 1024 / 1024:7.2f} MiB')
+        print(f'  speedup   {legacy_time / streaming_time:8.2f}x  memory {legacy_peak / streaming_peak:7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""
+Time-partitioned changeset storage.
+
+Changesets are stored in one collection per CHANGESET_BUCKET_SIZE period of their closed_at date,
+named after the period start (e.g. changeset_20240101). A changeset never changes its closed_at date,
+so it always routes to the same bucket, and expired changesets are removed by dropping whole buckets.
+"""
+
+import re
+import time
+from bisect import insort
+from collections.abc import Iterable, Sequence
+from datetime import UTC, datetime
+
+import pymongo
+from motor.core import AgnosticCollection
+from pymongo import IndexModel
+from pymongo.errors import BulkWriteError
+
+from config import CHANGESET_BUCKET_LIST_TTL, CHANGESET_BUCKET_SIZE
+from config_db import MONGO_DB
+
+_BUCKET_EPOCH = datetime(1970, 1, 5)  # a Monday
+_BUCKET_NAME_RE = re.compile(r'^changeset_(\d{8})$')
+
+_indexed_buckets: set[str] = set()
+
+# listing the collections on every query is not free: the list is cached, updated by this process
+# when it creates or drops a bucket, and reloaded after CHANGESET_BUCKET_LIST_TTL for the other processes
+_bucket_starts: list[datetime] | None = None
+_bucket_starts_expires = 0.0
+
+
+def _naive_utc(dt: datetime) -> datetime:
+    # documents read back from Mongo carry naive UTC dates
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(UTC).replace(tzinfo=None)
+    return dt
+
+
+def get_bucket_start(dt: datetime) -> datetime:
+    return _BUCKET_EPOCH + ((_naive_utc(dt) - _BUCKET_EPOCH) // CHANGESET_BUCKET_SIZE) * CHANGESET_BUCKET_SIZE
+
+
+def get_bucket_collection(bucket_start: datetime) -> AgnosticCollection:
+    return MONGO_DB[f'changeset_{bucket_start:%Y%m%d}']
+
+
+async def ensure_bucket(bucket_start: datetime) -> AgnosticCollection:
+    collection = get_bucket_collection(bucket_start)
+
+    if collection.name not in _indexed_buckets:
+        # creates the collection if needed
+        await collection.create_indexes(
+            [
+                IndexModel([('c', pymongo.ASCENDING)]),
+                IndexModel([('t.k', pymongo.ASCENDING), ('t.v', pymongo.ASCENDING), ('c', pymongo.ASCENDING)]),
+            ]
+        )
+        _indexed_buckets.add(collection.name)
+
+        if _bucket_starts is not None and bucket_start not in _bucket_starts:
+            insort(_bucket_starts, bucket_start)
+
+    return collection
+
+
+async def list_bucket_starts(*, cached: bool = False) -> list[datetime]:
+    """Return the start of the existing buckets, in chronological order."""
+    global _bucket_starts, _bucket_starts_expires
+
+    if cached and _bucket_starts is not None and time.monotonic() < _bucket_starts_expires:
+        return _bucket_starts.copy()
+
+    names = await MONGO_DB.list_collection_names(filter={'name': {'$regex': _BUCKET_NAME_RE.pattern}})
+    _bucket_starts = sorted(datetime.strptime(_BUCKET_NAME_RE.match(name)[1], '%Y%m%d') for name in names)
+    _bucket_starts_expires = time.monotonic() + CHANGESET_BUCKET_LIST_TTL.total_seconds()
+    return _bucket_starts.copy()
+
+
+async def get_bucket_collections(
+    from_: datetime | None = None,
+    to: datetime | None = None,
+    *,
+    descending: bool = False,
+) -> list[AgnosticCollection]:
+    """Return the existing buckets that overlap the given closed_at range, in chronological order."""
+    bucket_starts = await list_bucket_starts(cached=True)
+
+    if from_ is not None:
+        from_bucket = get_bucket_start(from_)
+        bucket_starts = [b for b in bucket_starts if b >= from_bucket]
+
+    if to is not None:
+        to_bucket = get_bucket_start(to)
+        bucket_starts = [b for b in bucket_starts if b <= to_bucket]
+
+    if descending:
+        bucket_starts.reverse()
+
+    return [get_bucket_collection(b) for b in bucket_starts]
+
+
+def group_by_bucket(changesets: Iterable[dict]) -> dict[datetime, list[dict]]:
+    result: dict[datetime, list[dict]] = {}
+
+    for changeset in changesets:
+        result.setdefault(get_bucket_start(changeset['c']), []).append(changeset)
+
+    return result
+
+
+async def insert_changesets(changesets: Sequence[dict]) -> None:
+    """Insert changesets into their buckets, ignoring the ones that are already stored."""
+    for bucket_start, bucket_changesets in group_by_bucket(changesets).items():
+        collection = await ensure_bucket(bucket_start)
+
+        try:
+            await collection.insert_many(bucket_changesets, ordered=False)
+        except BulkWriteError as e:
+            if any(error['code'] != 11000 for error in e.details['writeErrors']):
+                raise
+
+
+async def setup_buckets() -> None:
+    for bucket_start in await list_bucket_starts():
+        await ensure_bucket(bucket_start)
+
+
+async def drop_expired_buckets(expired_date: datetime) -> int:
+    """Drop the buckets that end before the expired date, and return how many were dropped."""
+    expired_date = _naive_utc(expired_date)
+    dropped = 0
+
+    for bucket_start in await list_bucket_starts():
+        if bucket_start + CHANGESET_BUCKET_SIZE > expired_date:
+            break
+
+        collection = get_bucket_collection(bucket_start)
+        print(f'[REPL] Dropping expired bucket {collection.name}')
+        await collection.drop()
+        _indexed_buckets.discard(collection.name)
+
+        if _bucket_starts is not None and bucket_start in _bucket_starts:
+            _bucket_starts.remove(bucket_start)
+
+        dropped += 1
+
+    return dropped
@@ -0,0 +1,144 @@
+import time
+from collections.abc import Sequence
+
+import pymongo
+from motor.core import AgnosticCollection
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+from changeset_buckets import ensure_bucket, get_bucket_collections, group_by_bucket
+from changeset_time_range import extend_changesets_time_range
+from config import REPLICATION_FLUSH_INTERVAL, REPLICATION_FLUSH_SIZE
+from config_db import MONGO_CLIENT
+from metrics import Counter, mongo_write_seconds
+from state import set_state_doc
+
+_ingested_changesets = Counter('thanos_changesets_ingested_total', 'Changesets written to the buckets.')
+
+
+async def _supports_transactions() -> bool:
+    hello = await MONGO_CLIENT.admin.command('hello')
+    return 'setName' in hello or hello.get('msg') == 'isdbgrid'
+
+
+async def _get_max_changeset_id() -> int:
+    result = 0
+
+    for collection in await get_bucket_collections():
+        doc = await collection.find_one(sort=[('_id', pymongo.DESCENDING)], projection={'_id': True})
+        if doc is not None:
+            result = max(result, doc['_id'])
+
+    return result
+
+
+def _upsert(changeset: dict) -> ReplaceOne:
+    return ReplaceOne({'_id': changeset['_id']}, changeset, upsert=True)
+
+
+async def _bulk_write(collection: AgnosticCollection, ops: list, **kwargs) -> None:
+    if ops:
+        await collection.bulk_write(ops, ordered=False, **kwargs)
+
+
+async def _bulk_write_or_upsert(collection: AgnosticCollection, ops: list, changesets: Sequence[dict]) -> None:
+    try:
+        await _bulk_write(collection, ops)
+    except BulkWriteError as e:
+        write_errors = e.details['writeErrors']
+
+        if any(error['code'] != 11000 for error in write_errors):
+            raise
+
+        # some inserted ids already existed: upsert them instead
+        await _bulk_write(collection, [_upsert(changesets[error['index']]) for error in write_errors])
+
+
+class ChangesetIngestBuffer:
+    """
+    Coalesces changesets from many replication sequences into large unordered writes, one per bucket.
+
+    Changeset ids above the highest stored _id cannot exist yet, so they are written as plain inserts.
+    Only the remaining ids pay for an upsert. The replication state and the changesets time range are advanced
+    together with each flush:
+    in a transaction when the deployment supports it, otherwise right after the batch.
+    Replaying a batch is harmless, because after a restart its ids are no longer above the highest stored id.
+    """
+
+    __slots__ = ('_changesets', '_first_add_time', '_last_replication_id', '_max_id', '_transactions')
+
+    def __init__(self, *, max_id: int, transactions: bool) -> None:
+        self._changesets: dict[int, dict] = {}
+        self._first_add_time: float | None = None
+        self._last_replication_id: int | None = None
+        self._max_id = max_id
+        self._transactions = transactions
+
+    @classmethod
+    async def create(cls) -> 'ChangesetIngestBuffer':
+        return cls(max_id=await _get_max_changeset_id(), transactions=await _supports_transactions())
+
+    def add(self, repl_id: int, changesets: Sequence[dict]) -> None:
+        if self._first_add_time is None:
+            self._first_add_time = time.monotonic()
+
+        # later sequences carry the newer version of a changeset
+        for changeset in changesets:
+            self._changesets[changeset['_id']] = changeset
+
+        self._last_replication_id = repl_id
+
+    def should_flush(self) -> bool:
+        if self._first_add_time is None:
+            return False
+
+        return (
+            len(self._changesets) >= REPLICATION_FLUSH_SIZE
+            or time.monotonic() - self._first_add_time >= REPLICATION_FLUSH_INTERVAL.total_seconds()
+        )
+
+    async def flush(self) -> None:
+        if self._last_replication_id is None:
+            return
+
+        changesets = tuple(self._changesets.values())
+        repl_id = self._last_replication_id
+        state = {'last_replication_id': repl_id}
+        buckets = []
+
+        for bucket_start, bucket_changesets in group_by_bucket(changesets).items():
+            collection = await ensure_bucket(bucket_start)
+            ops = [InsertOne(cs) if cs['_id'] > self._max_id else _upsert(cs) for cs in bucket_changesets]
+            buckets.append((collection, ops, bucket_changesets))
+
+        with mongo_write_seconds.time(operation='changeset_flush'):
+            if self._transactions:
+                async with await MONGO_CLIENT.start_session() as session:
+                    try:
+                        async with session.start_transaction():
+                            for collection, ops, _ in buckets:
+                                await _bulk_write(collection, ops, session=session)
+                            await set_state_doc('replication', state, session=session)
+                            await extend_changesets_time_range(changesets, session=session)
+                    except BulkWriteError:
+                        # the transaction was aborted: retry everything as upserts
+                        async with session.start_transaction():
+                            for collection, _, bucket_changesets in buckets:
+                                await _bulk_write(collection, list(map(_upsert, bucket_changesets)), session=session)
+                            await set_state_doc('replication', state, session=session)
+                            await extend_changesets_time_range(changesets, session=session)
+            else:
+                for collection, ops, bucket_changesets in buckets:
+                    await _bulk_write_or_upsert(collection, ops, bucket_changesets)
+                await set_state_doc('replication', state)
+                await extend_changesets_time_range(changesets)
+
+        _ingested_changesets.inc(len(changesets))
+
+        if changesets:
+            self._max_id = max(self._max_id, max(cs['_id'] for cs in changesets))
+
+        print(f'[REPL][{repl_id}] Flushed {len(changesets)} changesets')
+        self._changesets.clear()
+        self._first_add_time = None
+        self._last_replication_id = None
@@ -0,0 +1,103 @@
+import bz2
+import re
+from datetime import UTC, datetime
+
+import anyio
+from anyio import to_thread
+
+from changeset_buckets import insert_changesets
+from changeset_parser import ChangesetParser
+from changeset_time_range import extend_changesets_time_range
+from config import CHANGESET_MAX_AGE
+
+_READ_SIZE = 4 * 1024 * 1024
+_BATCH_SIZE = 10_000
+
+# e.g. changesets-240101.osm.bz2
+_FILENAME_DATE_RE = re.compile(r'changesets-(\d{6})\.osm\.bz2$')
+
+
+class _DumpReader:
+    __slots__ = ('_eof', '_file', '_parser')
+
+    def __init__(self, path: str, closed_after: datetime) -> None:
+        self._file = bz2.open(path, 'rb')  # noqa: SIM115  # handles multi-stream archives
+        self._parser = ChangesetParser(closed_after=closed_after)
+        self._eof = False
+
+    @property
+    def timestamp(self) -> datetime | None:
+        return self._parser.timestamp
+
+    def read(self) -> list[dict] | None:
+        """
+        Read and parse the next chunk of the dump.
+
+        Returns None when the dump is exhausted.
+        """
+        if self._eof:
+            return None
+
+        while data := self._file.read(_READ_SIZE):
+            if changesets := self._parser.feed(data):
+                return changesets
+
+        self._eof = True
+        return self._parser.close()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+async def load_changeset_dump(path: str) -> datetime:
+    """
+    Bulk-load changesets from a planet changeset dump (changesets-*.osm.bz2).
+
+    Only changesets within CHANGESET_MAX_AGE are kept. Returns the dump timestamp.
+    """
+    closed_after = datetime.now(UTC) - CHANGESET_MAX_AGE
+    reader = _DumpReader(path, closed_after)
+    send_stream, recv_stream = anyio.create_memory_object_stream(max_buffer_size=2)
+    total = 0
+
+    print(f'[REPL] Loading changeset dump {path!r} (closed after {closed_after:%Y-%m-%d})')
+
+    async with anyio.create_task_group() as tg:
+
+        async def insert_worker() -> None:
+            nonlocal total
+
+            async with recv_stream:
+                async for batch in recv_stream:
+                    # duplicates are expected when resuming an interrupted bootstrap
+                    await insert_changesets(batch)
+                    await extend_changesets_time_range(batch)
+                    total += len(batch)
+                    print(f'[REPL] Loaded {total} changesets from the dump')
+
+        tg.start_soon(insert_worker)
+
+        # decompress and parse in a worker thread, while the previous batch is being inserted
+        try:
+            async with send_stream:
+                batch = []
+
+                while (changesets := await to_thread.run_sync(reader.read)) is not None:
+                    batch.extend(changesets)
+
+                    if len(batch) >= _BATCH_SIZE:
+                        await send_stream.send(batch)
+                        batch = []
+
+                if batch:
+                    await send_stream.send(batch)
+        finally:
+            reader.close()
+
+    if reader.timestamp is not None:
+        return reader.timestamp
+
+    if match := _FILENAME_DATE_RE.search(path):
+        return datetime.strptime(match[1], '%y%m%d').replace(tzinfo=UTC)
+
+    raise ValueError(f'Unable to determine the timestamp of changeset dump {path!r}')
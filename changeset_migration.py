@@ -0,0 +1,108 @@
+from collections.abc import Callable, Sequence
+
+import anyio
+import pymongo
+from motor.core import AgnosticCollection
+
+from changeset_buckets import get_bucket_collections, insert_changesets
+from changeset_schema import CHANGESET_SCHEMA_VERSION, LEGACY_PROJECTION, legacy_to_compact
+from config_db import LEGACY_CHANGESET_COLLECTION, UNPARTITIONED_CHANGESET_COLLECTION
+from state import get_state_doc, set_state_doc
+
+_BATCH_SIZE = 5000
+
+_is_migrated = False
+
+
+async def is_migrated() -> bool:
+    """Check whether all changesets are stored in the compact, time-partitioned schema."""
+    global _is_migrated
+
+    if not _is_migrated:
+        doc = await get_state_doc('changeset_schema')
+        _is_migrated = doc is not None and doc['version'] >= CHANGESET_SCHEMA_VERSION
+
+    return _is_migrated
+
+
+async def _get_storage_stats(collection: AgnosticCollection) -> dict | None:
+    if not await collection.database.list_collection_names(filter={'name': collection.name}):
+        return None
+
+    cursor = collection.aggregate([{'$collStats': {'storageStats': {'scale': 1024 * 1024}}}])
+    doc = await cursor.next()
+    return doc['storageStats']
+
+
+async def _print_storage_stats(name: str, collections: Sequence[AgnosticCollection]) -> None:
+    count = size = storage_size = index_size = 0
+    index_sizes: dict[str, float] = {}
+
+    for collection in collections:
+        stats = await _get_storage_stats(collection)
+        if stats is None:
+            continue
+
+        count += stats.get('count', 0)
+        size += stats.get('size', 0)
+        storage_size += stats.get('storageSize', 0)
+        index_size += stats.get('totalIndexSize', 0)
+
+        for k, v in stats.get('indexSizes', {}).items():
+            index_sizes[k] = index_sizes.get(k, 0) + v
+
+    indexes = ', '.join(f'{k}={v:.1f}' for k, v in index_sizes.items())
+    print(
+        f'[MIGRATION] {name}: {count} documents, data {size:.1f} MiB, storage {storage_size:.1f} MiB, '
+        f'indexes {index_size:.1f} MiB ({indexes})'
+    )
+
+
+async def _migrate_collection(
+    collection: AgnosticCollection,
+    id_field: str,
+    projection: dict | None,
+    to_compact: Callable[[dict], dict],
+) -> None:
+    migrated = 0
+
+    while True:
+        cursor = collection.find(projection=projection).sort(id_field, pymongo.ASCENDING).limit(_BATCH_SIZE)
+        docs = [to_compact(doc) async for doc in cursor]
+
+        if not docs:
+            break
+
+        # replication may have already written a newer copy, which is kept
+        await insert_changesets(docs)
+        await collection.delete_many({id_field: {'$in': [doc['_id'] for doc in docs]}})
+        migrated += len(docs)
+        print(f'[MIGRATION] Migrated {migrated} changesets from {collection.name}')
+
+        # yield to the replication worker and user requests
+        await anyio.sleep(0.1)
+
+    await collection.drop()
+
+
+async def migrate_changesets() -> None:
+    """
+    Move changesets from the legacy collections into the compact, time-partitioned buckets, in the background.
+
+    Each batch is inserted before it is deleted from its source collection. Readers query the source
+    collections first (legacy, then unpartitioned) and the buckets last, so they never miss a changeset.
+    """
+    if await is_migrated():
+        return
+
+    print('[MIGRATION] Migrating changesets to the compact, time-partitioned schema')
+    await _print_storage_stats(LEGACY_CHANGESET_COLLECTION.name, (LEGACY_CHANGESET_COLLECTION,))
+    await _print_storage_stats(UNPARTITIONED_CHANGESET_COLLECTION.name, (UNPARTITIONED_CHANGESET_COLLECTION,))
+    await _print_storage_stats('buckets', await get_bucket_collections())
+
+    await _migrate_collection(LEGACY_CHANGESET_COLLECTION, '@id', LEGACY_PROJECTION, legacy_to_compact)
+    await _migrate_collection(UNPARTITIONED_CHANGESET_COLLECTION, '_id', None, lambda doc: doc)
+
+    await set_state_doc('changeset_schema', {'version': CHANGESET_SCHEMA_VERSION})
+    await _print_storage_stats('buckets', await get_bucket_collections())
+    print('[MIGRATION] Finished migrating changesets')
@@ -0,0 +1,73 @@
+from datetime import datetime
+from xml.parsers import expat
+
+
+class ChangesetParser:
+    """
+    Incremental parser for OSM changeset XML documents, producing compact changeset documents.
+
+    Changesets that are commented, empty, still open or closed before `closed_after` are skipped
+    at their start tag, before any of their attributes or tags are converted.
+    """
+
+    __slots__ = ('_changeset', '_closed_after', '_parser', '_result', '_tags', 'timestamp')
+
+    def __init__(self, *, closed_after: datetime | None = None) -> None:
+        # timestamps are fixed-width ISO 8601 strings, so they compare lexicographically
+        self._closed_after = closed_after.strftime('%Y-%m-%dT%H:%M:%SZ') if closed_after is not None else ''
+        self._parser = expat.ParserCreate()
+        self._parser.buffer_text = True
+        self._parser.StartElementHandler = self._start_element
+        self._parser.EndElementHandler = self._end_element
+        self._changeset: dict | None = None
+        self._tags: list[dict[str, str]] | None = None
+        self._result: list[dict] = []
+        self.timestamp: datetime | None = None
+
+    def feed(self, data: bytes) -> list[dict]:
+        self._parser.Parse(data, False)
+        return self._pop_result()
+
+    def close(self) -> list[dict]:
+        self._parser.Parse(b'', True)
+        return self._pop_result()
+
+    def _pop_result(self) -> list[dict]:
+        result = self._result
+        self._result = []
+        return result
+
+    def _start_element(self, name: str, attrs: dict[str, str]) -> None:
+        if name == 'tag':
+            if self._tags is not None:
+                self._tags.append({'k': attrs['k'], 'v': attrs['v']})
+            return
+
+        if name == 'changeset':
+            if attrs.get('comments_count') != '0' or attrs.get('num_changes') == '0' or attrs.get('open') != 'false':
+                return
+            if attrs['closed_at'] < self._closed_after:
+                return
+
+            self._changeset = {
+                '_id': int(attrs['id']),
+                'u': int(attrs['uid']),
+                'n': int(attrs['num_changes']),
+                'c': datetime.fromisoformat(attrs['closed_at']),
+            }
+            self._tags = []
+            return
+
+        if name == 'osm' and 'timestamp' in attrs:
+            self.timestamp = datetime.fromisoformat(attrs['timestamp'])
+
+    def _end_element(self, name: str) -> None:
+        if name != 'changeset' or self._changeset is None:
+            return
+
+        changeset = self._changeset
+        changeset['t'] = self._tags
+        self._result.append(changeset)
+
+        self._changeset = None
+        self._tags = None
@@ -0,0 +1,36 @@
+"""
+Compact changeset documents, introduced in schema version 2.
+
+    _id  changeset id
+    u    user id
+    n    number of changes
+    c    closed at
+    t    tags, as a list of {k, v} pairs
+"""
+
+CHANGESET_SCHEMA_VERSION = 3  # 2 + partitioned into changeset_buckets
+
+# the version 1 fields needed by legacy_to_compact
+LEGACY_PROJECTION = {'_id': False, '@id': True, '@uid': True, '@num_changes': True, '@closed_at': True, 'tags': True}
+
+
+def legacy_to_compact(doc: dict) -> dict:
+    """Convert a version 1 document (xmltodict attributes and a tags dict) into the compact schema."""
+    return {
+        '_id': doc['@id'],
+        'u': doc['@uid'],
+        'n': doc['@num_changes'],
+        'c': doc['@closed_at'],
+        't': [{'k': k, 'v': v} for k, v in doc['tags'].items() if k != '__empty__'],
+    }
+
+
+def changeset_from_doc(doc: dict) -> dict:
+    """Expand a compact document into the shape served to the classify page."""
+    return {
+        '@id': doc['_id'],
+        '@uid': doc['u'],
+        '@num_changes': doc['n'],
+        '@closed_at': doc['c'],
+        'tags': {tag['k']: tag['v'] for tag in doc['t']},
+    }
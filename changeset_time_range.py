@@ -0,0 +1,80 @@
+"""
+The closed_at range of all stored changesets, shown on the index page.
+
+It is kept in a state document instead of being queried on every page view: new changesets extend it
+with $min/$max, and the expiry cleanup recomputes it.
+"""
+
+from collections.abc import Sequence
+from datetime import datetime
+
+import pymongo
+from motor.core import AgnosticCollection
+
+from changeset_buckets import get_bucket_collections
+from changeset_migration import is_migrated
+from config_db import LEGACY_CHANGESET_COLLECTION, UNPARTITIONED_CHANGESET_COLLECTION
+from state import get_state_doc, update_state_doc
+
+_STATE_NAME = 'changesets_time_range'
+
+
+async def _find_one_closed_at(collection: AgnosticCollection, field: str, direction: int) -> datetime | None:
+    doc = await collection.find_one(sort=[(field, direction)], projection={'_id': False, field: True})
+    return doc[field] if doc is not None else None
+
+
+async def _find_closed_at(direction: int) -> datetime | None:
+    result = []
+
+    if not await is_migrated():
+        result.append(await _find_one_closed_at(LEGACY_CHANGESET_COLLECTION, '@closed_at', direction))
+        result.append(await _find_one_closed_at(UNPARTITIONED_CHANGESET_COLLECTION, 'c', direction))
+
+    # buckets are disjoint and ordered in the search direction
+    for collection in await get_bucket_collections(descending=direction == pymongo.DESCENDING):
+        closed_at = await _find_one_closed_at(collection, 'c', direction)
+
+        if closed_at is not None:
+            result.append(closed_at)
+            break
+
+    result = [closed_at for closed_at in result if closed_at is not None]
+
+    if not result:
+        return None
+
+    return min(result) if direction == pymongo.ASCENDING else max(result)
+
+
+async def extend_changesets_time_range(changesets: Sequence[dict], **kwargs) -> None:
+    if not changesets:
+        return
+
+    closed_at = [changeset['c'] for changeset in changesets]
+    update = {'$min': {'first': min(closed_at)}, '$max': {'last': max(closed_at)}}
+    await update_state_doc(_STATE_NAME, update, **kwargs)
+
+
+async def refresh_changesets_time_range() -> tuple[datetime | None, datetime | None]:
+    """Recompute the range from the stored changesets, after some of them were removed."""
+    first = await _find_closed_at(pymongo.ASCENDING)
+    last = await _find_closed_at(pymongo.DESCENDING)
+
+    # $max keeps a newer value written by a concurrent extend
+    update = {'$set': {'first': first}} if first is not None else {'$unset': {'first': True}}
+
+    if last is not None:
+        update['$max'] = {'last': last}
+
+    await update_state_doc(_STATE_NAME, update)
+    return first, last
+
+
+async def get_changesets_time_range() -> tuple[datetime | None, datetime | None]:
+    doc = await get_state_doc(_STATE_NAME)
+
+    if doc is None:
+        return await refresh_changesets_time_range()
+
+    return doc.get('first'), doc.get('last')
@@ -46,11 +46,54 @@ if DRY_RUN:
 REPLICATION_URL = 'https://planet.openstreetmap.org/replication/changesets/'
 REPLICATION_FREQUENCY = timedelta(minutes=1)
 REPLICATION_SLEEP = timedelta(seconds=30)
+REPLICATION_PREFETCH = int(os.getenv('REPLICATION_PREFETCH', '16'))  # sequences downloaded ahead while catching up
+REPLICATION_FLUSH_SIZE = int(os.getenv('REPLICATION_FLUSH_SIZE', '20000'))  # changesets per coalesced write
+REPLICATION_FLUSH_INTERVAL = timedelta(seconds=10)
 
 OSM_PLANET_URL = 'https://planet.openstreetmap.org/'
 OSM_API_URL = 'https://api.openstreetmap.org/api/0.6/'
 
+# connection pool of each upstream http client
+HTTP2 = os.getenv('HTTP2', '0').lower() in ('1', 'true', 'yes')
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', '32'))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('HTTP_MAX_KEEPALIVE_CONNECTIONS', '16'))
+HTTP_KEEPALIVE_EXPIRY = timedelta(seconds=30)
+HTTP_TIMEOUT = timedelta(seconds=60)
+
+DELETED_USERS_PATH = os.getenv('DELETED_USERS_PATH', f'/tmp/{NAME}-deleted-users.bin')
+DELETED_USERS_REFRESH_INTERVAL = timedelta(hours=1)
+
+# user info is served from the cache, and refreshed in the background after the soft ttl
+USER_INFO_SOFT_TTL = timedelta(minutes=float(os.getenv('USER_INFO_SOFT_TTL', '5')))
+USER_INFO_HARD_TTL = timedelta(hours=float(os.getenv('USER_INFO_HARD_TTL', '24')))
+USER_LOOKUP_CONCURRENCY = int(os.getenv('USER_LOOKUP_CONCURRENCY', '4'))  # users.json requests in flight
+USER_LOOKUP_BATCH_SIZE = int(os.getenv('USER_LOOKUP_BATCH_SIZE', '500'))  # max users per users.json request
+
 CHANGESET_CONCURRENCY = int(os.getenv('CHANGESET_CONCURRENCY', '5'))
+
+METRICS_SNAPSHOT_INTERVAL = timedelta(seconds=5)  # per-worker metrics files, merged by /metrics
+
+# spans slower than that are printed, and traces are exported to this directory if set
+TRACE_PRINT_THRESHOLD = timedelta(seconds=float(os.getenv('TRACE_PRINT_THRESHOLD', '1')))
+TRACE_EXPORT_DIR = os.getenv('TRACE_EXPORT_DIR', None)
+TRACE_EXPORT_INTERVAL = timedelta(seconds=1)  # finished traces are appended in batches, off the event loop
+
+# warm osm_revert worker processes, see revert_pool
+REVERT_POOL_SIZE = int(os.getenv('REVERT_POOL_SIZE', str(CHANGESET_CONCURRENCY)))  # idle workers kept
+REVERT_POOL_MAX_JOBS = int(os.getenv('REVERT_POOL_MAX_JOBS', '100'))  # jobs before a worker is recycled
+REVERT_GLOBAL_CONCURRENCY = int(os.getenv('REVERT_GLOBAL_CONCURRENCY', str(CHANGESET_CONCURRENCY)))  # all tasks
+REVERT_TIMEOUT = timedelta(minutes=5)  # per job, the worker is killed after that
+REVERT_TIMEOUT_PER_CHANGESET = timedelta(seconds=30)  # added for every grouped changeset after the first
+REVERT_GROUP_MAX_CHANGES = int(os.getenv('REVERT_GROUP_MAX_CHANGES', '10000'))  # num_changes budget per batch
+REVERT_STORE_FLUSH_INTERVAL = timedelta(seconds=2)  # task progress and changeset statuses are written in batches
+REVERT_STORE_SHUTDOWN_TIMEOUT = timedelta(seconds=10)  # for the final flush, which would otherwise retry forever
 CHANGESET_MAX_AGE = timedelta(days=float(os.getenv('CHANGESET_MAX_AGE', '180')))  # 6 months
+CHANGESET_BUCKET_SIZE = timedelta(days=7)
+CHANGESET_BUCKET_LIST_TTL = timedelta(seconds=10)  # buckets created by another worker are queried after at most this
+CHANGESETS_PAGE_SIZE = 10000  # changesets per /api/changesets response
+
+# planet changeset dump (changesets-*.osm.bz2) to bootstrap an empty database from
+CHANGESET_DUMP_PATH = os.getenv('CHANGESET_DUMP_PATH', None)
 
-LOGS_QUEUE_SIZE = 1024
+LOGS_TAIL_SIZE = 1024  # log lines rendered on the revert page, or sent at once to its event stream
+TASK_LOG_MAX_EVENTS = int(os.getenv('TASK_LOG_MAX_EVENTS', '100000'))  # per task, about 85 bytes each
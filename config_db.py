@@ -1,23 +1,35 @@
 import os
 
 import pymongo
-from motor.core import AgnosticCollection
+from motor.core import AgnosticCollection, AgnosticDatabase
 from motor.motor_asyncio import AsyncIOMotorClient
 from pymongo import IndexModel
 
-from config import NAME
+from config import NAME, USER_INFO_HARD_TTL
 
 MONGO_HOST = os.getenv('MONGO_HOST', '127.0.0.1')
 MONGO_PORT = int(os.getenv('MONGO_PORT', '27017'))
 MONGO_CLIENT = AsyncIOMotorClient(f'mongodb://{MONGO_HOST}:{MONGO_PORT}')
-_mongo_db = MONGO_CLIENT[NAME]
+MONGO_DB_NAME = os.getenv('MONGO_DB_NAME', NAME)  # a separate database, e.g. for benchmarks
+MONGO_DB: AgnosticDatabase = MONGO_CLIENT[MONGO_DB_NAME]
 
-STATE_COLLECTION: AgnosticCollection = _mongo_db['state']
-CHANGESET_COLLECTION: AgnosticCollection = _mongo_db['changeset']
+STATE_COLLECTION: AgnosticCollection = MONGO_DB['state']
+
+# schema versions 1 and 2, drained by changeset_migration into the changeset_buckets
+LEGACY_CHANGESET_COLLECTION: AgnosticCollection = MONGO_DB['changeset']
+UNPARTITIONED_CHANGESET_COLLECTION: AgnosticCollection = MONGO_DB['changeset_v2']
+
+USER_CACHE_COLLECTION: AgnosticCollection = MONGO_DB['user_cache']
+
+# revert tasks and the status of their changesets, see revert_store
+REVERT_TASK_COLLECTION: AgnosticCollection = MONGO_DB['revert_task']
+REVERT_STATUS_COLLECTION: AgnosticCollection = MONGO_DB['revert_status']
 
 async def setup_mongo():
-    await CHANGESET_COLLECTION.create_indexes([
-        IndexModel([('@id', pymongo.ASCENDING)], unique=True),
-        IndexModel([('@closed_at', pymongo.ASCENDING)]),
-        IndexModel([('tags.$**', pymongo.ASCENDING)]),
+    await USER_CACHE_COLLECTION.create_indexes([
+        IndexModel([('fetched_at', pymongo.ASCENDING)], expireAfterSeconds=int(USER_INFO_HARD_TTL.total_seconds())),
+    ])
+
+    await REVERT_STATUS_COLLECTION.create_indexes([
+        IndexModel([('t', pymongo.ASCENDING), ('c', pymongo.ASCENDING)], unique=True),
     ])
@@ -0,0 +1,163 @@
+"""
+Index of deleted OpenStreetMap accounts, from the planet users_deleted.txt list.
+
+The list is append-only, so the refresher (primary worker only) downloads just its new tail with
+a range request. The ids are kept as a sorted array of int64, and persisted to DELETED_USERS_PATH
+as a JSON header line followed by the raw array. Every worker reloads the file when it changes.
+"""
+
+import bisect
+from array import array
+from collections.abc import Iterable
+from pathlib import Path
+
+import anyio
+import orjson
+from anyio import to_thread
+from httpx import AsyncClient, codes
+
+from config import DELETED_USERS_PATH, DELETED_USERS_REFRESH_INTERVAL
+from http_clients import get_planet_client
+from tracing import span
+from utils import retry_exponential
+
+_LIST_PATH = 'users_deleted/users_deleted.txt'
+_INDEX_PATH = Path(DELETED_USERS_PATH)
+
+_ids = array('q')
+_loaded_mtime: int | None = None
+_load_lock = anyio.Lock()
+
+
+def _parse_ids(text: bytes) -> list[int]:
+    result = []
+
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith(b'#'):
+            continue
+
+        result.append(int(line))
+
+    return result
+
+
+def _read_index() -> tuple[dict, array]:
+    with _INDEX_PATH.open('rb') as f:
+        header = orjson.loads(f.readline())
+        ids = array('q')
+        ids.frombytes(f.read())
+
+    return header, ids
+
+
+def _write_index(header: dict, ids: array) -> None:
+    tmp_path = _INDEX_PATH.with_name(_INDEX_PATH.name + '.tmp')
+
+    with tmp_path.open('wb') as f:
+        f.write(orjson.dumps(header) + b'\n')
+        ids.tofile(f)
+
+    # readers never see a partially written index
+    tmp_path.replace(_INDEX_PATH)
+
+
+def _merge_ids(ids: array, new_ids: list[int]) -> array:
+    new_ids.sort()
+
+    # the list is mostly appended in increasing order
+    if not ids or (new_ids and new_ids[0] > ids[-1]):
+        result = array('q', ids)
+        result.extend(new_ids)
+        return result
+
+    return array('q', sorted(set(ids).union(new_ids)))
+
+
+async def _reload() -> None:
+    global _ids, _loaded_mtime
+
+    try:
+        mtime = (await anyio.Path(_INDEX_PATH).stat()).st_mtime_ns
+    except FileNotFoundError:
+        return
+
+    if mtime == _loaded_mtime:
+        return
+
+    async with _load_lock:
+        if mtime == _loaded_mtime:
+            return
+
+        _, _ids = await to_thread.run_sync(_read_index)
+        _loaded_mtime = mtime
+
+
+async def get_deleted_users(uids: Iterable[int]) -> set[int]:
+    """
+    Return the given user ids that belong to deleted accounts.
+
+    Never waits for a download: before the first refresh has finished, no user is reported as deleted.
+    """
+    with span('get_deleted_users'):
+        await _reload()
+        ids = _ids
+        size = len(ids)
+        result = set()
+
+        for uid in uids:
+            i = bisect.bisect_left(ids, uid)
+            if i < size and ids[i] == uid:
+                result.add(uid)
+
+    return result
+
+
+@retry_exponential(None)
+async def _refresh(http: AsyncClient) -> None:
+    try:
+        header, ids = await to_thread.run_sync(_read_index)
+    except (FileNotFoundError, ValueError):
+        header, ids = {'offset': 0, 'etag': None}, array('q')
+
+    headers = {}
+
+    if header['offset'] and header['etag']:
+        headers['Range'] = f'bytes={header["offset"]}-'
+        headers['If-Range'] = header['etag']
+
+    r = await http.get(_LIST_PATH, headers=headers)
+
+    if r.status_code == codes.REQUESTED_RANGE_NOT_SATISFIABLE:
+        return
+
+    r.raise_for_status()
+
+    if r.status_code == codes.PARTIAL_CONTENT:
+        offset = header['offset']
+    else:
+        # the file was replaced, or this is the first download
+        offset = 0
+        ids = array('q')
+
+    # only parse complete lines, the rest is fetched on the next refresh
+    content = r.content
+    content = content[: content.rfind(b'\n') + 1]
+
+    if not content:
+        return
+
+    new_ids = await to_thread.run_sync(_parse_ids, content)
+    ids = await to_thread.run_sync(_merge_ids, ids, new_ids)
+    header = {'offset': offset + len(content), 'etag': r.headers.get('ETag')}
+
+    await to_thread.run_sync(_write_index, header, ids)
+    print(f'[DELETED] Indexed {len(new_ids)} new deleted users, {len(ids)} in total')
+
+
+async def run_deleted_users_refresher() -> None:
+    while True:
+        with span('refresh_deleted_users'):
+            await _refresh(get_planet_client())
+
+        await anyio.sleep(DELETED_USERS_REFRESH_INTERVAL.total_seconds())
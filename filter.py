@@ -1,160 +1,433 @@
-from collections.abc import Sequence
+import heapq
+import time
+from collections.abc import AsyncIterator, Sequence
+from contextlib import aclosing
 from datetime import datetime, timedelta
-from itertools import islice
 
-import anyio
 import pymongo
-from asyncache import cached
-from cachetools import TTLCache
+from motor.core import AgnosticCollection, AgnosticCursor
+
+from changeset_buckets import get_bucket_collections
+from changeset_migration import is_migrated
+from changeset_schema import LEGACY_PROJECTION, changeset_from_doc, legacy_to_compact
+from config_db import LEGACY_CHANGESET_COLLECTION, UNPARTITIONED_CHANGESET_COLLECTION
+from metrics import Counter, Histogram
+from tracing import record_timing, span
+from user_info import get_latest_user_info
+
+# fields served to the classify page, see changeset_from_doc
+_PROJECTION = ('u', 'n', 'c', 't')
+
+_query_seconds = Histogram('thanos_changesets_query_seconds', 'Duration of streaming a page of changesets.')
+_queried_changesets = Counter('thanos_changesets_queried_total', 'Changesets streamed to the classify page.')
+
+
+async def _get_collections(
+    from_: datetime | None = None,
+    to: datetime | None = None,
+    *,
+    descending: bool = False,
+) -> list[tuple[AgnosticCollection, bool]]:
+    """
+    Return the collections to read, paired with a flag marking the legacy (version 1) schema.
+
+    While the migration is running, its source collections come first: documents are inserted into
+    the buckets before they are deleted from the sources.
+    """
+    result = []
+
+    if not await is_migrated():
+        result.append((LEGACY_CHANGESET_COLLECTION, True))
+        result.append((UNPARTITIONED_CHANGESET_COLLECTION, False))
+
+    result.extend((c, False) for c in await get_bucket_collections(from_, to, descending=descending))
+    return result
 
-from config import OSM_API_URL, OSM_PLANET_URL
-from config_db import CHANGESET_COLLECTION
-from utils import get_http_client, print_run_time, retry_exponential
 
-_user_info_cache = TTLCache(maxsize=32 * 1024, ttl=60)
+def _union_pipeline(pipelines: Sequence[tuple[AgnosticCollection, list[dict]]]) -> tuple[AgnosticCollection, list]:
+    """Combine per-collection pipelines with $unionWith, to be aggregated on the first collection."""
+    collection, pipeline = pipelines[0]
+    pipeline = pipeline.copy()
+    pipeline.extend({'$unionWith': {'coll': c.name, 'pipeline': p}} for c, p in pipelines[1:])
+    return collection, pipeline
 
 
-async def get_changesets_time_range() -> tuple[datetime, datetime]:
-    first_doc = await CHANGESET_COLLECTION.find_one(
-        sort=[('@closed_at', 1)],
-        projection={'_id': False, '@closed_at': True},
-    )
-    last_doc = await CHANGESET_COLLECTION.find_one(
-        sort=[('@closed_at', -1)],
-        projection={'_id': False, '@closed_at': True},
-    )
-    return first_doc['@closed_at'], last_doc['@closed_at']
+async def get_specific_changesets_time_range(
+    changesets: Sequence[int],
+) -> tuple[datetime, datetime] | tuple[None, None]:
+    """Return the closed_at range of the stored changesets among the given ones, in a single $min/$max aggregation."""
+    pipelines = []
 
+    for collection, is_legacy in await _get_collections():
+        if is_legacy:
+            pipeline = [
+                {'$match': {'@id': {'$in': changesets}}},
+                {'$project': {'_id': False, 'c': '$@closed_at'}},
+            ]
+        else:
+            pipeline = [
+                {'$match': {'_id': {'$in': changesets}}},
+                {'$project': {'_id': False, 'c': True}},
+            ]
 
-async def get_specific_changesets_time_range(changesets: Sequence[int]) -> tuple[datetime, datetime]:
-    first_doc = await CHANGESET_COLLECTION.find_one(
-        {'@id': {'$in': changesets}},
-        sort=[('@closed_at', 1)],
-        projection={'_id': False, '@closed_at': True},
-    )
-    last_doc = await CHANGESET_COLLECTION.find_one(
-        {'@id': {'$in': changesets}},
-        sort=[('@closed_at', -1)],
-        projection={'_id': False, '@closed_at': True},
-    )
-    return first_doc['@closed_at'], last_doc['@closed_at']
+        pipelines.append((collection, pipeline))
 
+    if not pipelines:
+        return None, None
 
-@cached(TTLCache(maxsize=1, ttl=8 * 3600))
-async def _fetch_deleted_users() -> frozenset[int]:
-    async with get_http_client(OSM_PLANET_URL) as http:
-        r = await http.get('users_deleted/users_deleted.txt')
-        r.raise_for_status()
+    collection, pipeline = _union_pipeline(pipelines)
+    pipeline.append({'$group': {'_id': None, 'first': {'$min': '$c'}, 'last': {'$max': '$c'}}})
 
-    result = set()
+    docs = await collection.aggregate(pipeline).to_list(None)
 
-    for line in r.text.splitlines():
-        line = line.strip()
-        if not line or line.startswith('#'):
-            continue
+    if not docs:
+        return None, None
 
-        result.add(int(line))
+    return docs[0]['first'], docs[0]['last']
 
-    return frozenset(result)
 
+async def get_changesets_info(changesets: Sequence[int]) -> dict[int, dict]:
+    """Return the user id (u) and number of changes (n) of the given changesets that are stored."""
+    pipelines = []
 
-async def _fetch_latest_user_info(uids: Sequence[int]) -> dict[int, dict | None]:
-    result = {}
-    uids_set = set(uids)
+    for collection, is_legacy in await _get_collections():
+        if is_legacy:
+            pipeline = [
+                {'$match': {'@id': {'$in': changesets}}},
+                {'$project': {'_id': '$@id', 'u': '$@uid', 'n': '$@num_changes'}},
+            ]
+        else:
+            pipeline = [
+                {'$match': {'_id': {'$in': changesets}}},
+                {'$project': {'u': True, 'n': True}},
+            ]
 
-    with print_run_time('Fetching deleted users'):
-        deleted_uids = await _fetch_deleted_users()
+        pipelines.append((collection, pipeline))
 
-    # check for deleted users
-    for uid in uids_set.intersection(deleted_uids):
-        result[uid] = None
-        uids_set.remove(uid)
+    if not pipelines:
+        return {}
 
-    # check for cached users
-    for uid in tuple(uids_set):
-        try:
-            result[uid] = _user_info_cache[uid]
-            uids_set.remove(uid)
-        except KeyError:
-            pass
+    collection, pipeline = _union_pipeline(pipelines)
+    return {doc['_id']: doc async for doc in collection.aggregate(pipeline)}
 
-    # small optimization
-    if not uids_set:
-        return result
-
-    async with get_http_client(OSM_API_URL) as http, anyio.create_task_group() as tg:
-
-        @retry_exponential(timedelta(seconds=30))
-        async def process(batch: Sequence[int]):
-            r = await http.get('users.json', params={'users': ','.join(map(str, batch))})
-
-            # at some point, api returned 404 if at least one user is not found
-            if r.status_code == 404:
-                if len(batch) == 1:
-                    uid = batch[0]
-                    _user_info_cache[uid] = result[uid] = None
-                else:
-                    mid = len(batch) // 2
-                    batch1, batch2 = batch[:mid], batch[mid:]
-                    tg.start_soon(process, batch1)
-                    tg.start_soon(process, batch2)
-            else:
-                r.raise_for_status()
-                batch_set = set(batch)
 
-                for user in r.json()['users']:
-                    user = user['user']
-                    uid = user['id']
-                    _user_info_cache[uid] = result[uid] = user
-                    batch_set.remove(uid)
+def _tags_query(tags: Sequence[str]) -> list[dict]:
+    result = []
 
-                for uid in batch_set:
-                    _user_info_cache[uid] = result[uid] = None
+    for tag in tags:
+        tag_split = tag.split('=', 1)
 
-        uids_iter = iter(uids_set)
-        batch_size = 500
-        while batch := tuple(islice(uids_iter, batch_size)):
-            tg.start_soon(process, batch)
+        if len(tag_split) == 2 and tag_split[1] != '*':
+            key, value = tag_split
+            result.append({'t': {'$elemMatch': {'k': key, 'v': value}}})
+        elif tag_split[0] == '__empty__':
+            # compatibility with the legacy empty tags sentinel
+            result.append({'t': {'$size': 0}})
+        else:
+            key = tag_split[0]
+            result.append({'t.k': key})
 
     return result
 
 
-async def query_changesets(from_: datetime, to: datetime, tags: Sequence[str]) -> dict[int, dict]:
-    query = {
-        '@closed_at': {
-            '$gte': from_,
-            '$lte': to,
-        },
-    }
+def _legacy_tags_query(tags: Sequence[str]) -> list[dict]:
+    tag_query = {}
+
+    for tag in tags:
+        tag_split = tag.split('=', 1)
+
+        if len(tag_split) == 2 and tag_split[1] != '*':
+            key, value = tag_split
+            tag_query[f'tags.{key}'] = value
+        else:
+            key = tag_split[0]
+            tag_query[f'tags.{key}'] = {'$exists': True}
+
+    return [{k: v} for k, v in tag_query.items()]
+
+
+def _match_queries(from_: datetime, to: datetime, tags: Sequence[str], after: int = 0) -> tuple[dict, dict]:
+    """Return the (legacy, compact) queries matching changesets closed in the range, with the given tags."""
+    legacy_query = {'@closed_at': {'$gte': from_, '$lte': to}}
+    query = {'c': {'$gte': from_, '$lte': to}}
+
+    if after:
+        legacy_query['@id'] = {'$gt': after}
+        query['_id'] = {'$gt': after}
 
     if tags:
-        tag_query = {}
+        legacy_query['$and'] = _legacy_tags_query(tags)
+        query['$and'] = _tags_query(tags)
+
+    return legacy_query, query
+
 
-        for tag in tags:
-            tag_split = tag.split('=', 1)
+async def _iter_legacy_docs(cursor: AgnosticCursor) -> AsyncIterator[dict]:
+    async for doc in cursor:
+        yield legacy_to_compact(doc)
+
+
+async def iter_changeset_docs(from_: datetime, to: datetime, tags: Sequence[str], after: int) -> AsyncIterator[dict]:
+    """Yield matching compact documents in ascending id order, merged across all collections, without user info."""
+    legacy_query, query = _match_queries(from_, to, tags, after)
+    cursors = []
+    iterators = []
+
+    for collection, is_legacy in await _get_collections(from_, to):
+        if is_legacy:
+            cursor = collection.find(legacy_query, projection=LEGACY_PROJECTION).sort('@id', pymongo.ASCENDING)
+            iterators.append(_iter_legacy_docs(cursor))
+        else:
+            cursor = collection.find(query, projection=_PROJECTION).sort('_id', pymongo.ASCENDING)
+            iterators.append(cursor)
+
+        cursors.append(cursor)
+
+    # the cursors fetch in batches: time them as a whole, not with a span per document
+    cursor_ns = 0
+
+    try:
+        heap = []
+        ts = time.perf_counter_ns()
+
+        for index, iterator in enumerate(iterators):
+            doc = await anext(iterator, None)
+            if doc is not None:
+                heap.append((doc['_id'], index, doc))
+
+        cursor_ns += time.perf_counter_ns() - ts
+        heapq.heapify(heap)
 
-            if len(tag_split) == 2 and tag_split[1] != '*':
-                key, value = tag_split
-                tag_query[f'tags.{key}'] = value
+        while heap:
+            id, index, doc = heap[0]
+            ts = time.perf_counter_ns()
+            next_doc = await anext(iterators[index], None)
+            cursor_ns += time.perf_counter_ns() - ts
+
+            if next_doc is not None:
+                heapq.heapreplace(heap, (next_doc['_id'], index, next_doc))
             else:
-                key = tag_split[0]
-                tag_query[f'tags.{key}'] = {'$exists': True}
+                heapq.heappop(heap)
+
+            # while migrating, a changeset may be stored twice: the copy from the later collection is newer
+            if heap and heap[0][0] == id:
+                continue
+
+            yield doc
+
+    finally:
+        for cursor in cursors:
+            await cursor.close()
+
+        record_timing('mongo_cursor', cursor_ns / 1e9)
+
+
+async def _add_user_info(docs: Sequence[dict]) -> list[dict]:
+    with span('latest_user_info'):
+        latest_user_info = await get_latest_user_info({doc['u'] for doc in docs})
+
+    return [changeset_from_doc(doc) | {'user': latest_user_info[doc['u']]} for doc in docs]
+
+
+async def query_changesets(
+    from_: datetime,
+    to: datetime,
+    tags: Sequence[str],
+    *,
+    after: int = 0,
+    limit: int | None = None,
+    batch_size: int = 1000,
+) -> AsyncIterator[list[dict]]:
+    """
+    Stream matching changesets in ascending id order, in batches with the latest user info.
+
+    Use the id of the last changeset as `after` to continue with the next page.
+    """
+    batch = []
+    count = 0
+
+    # including the time the client takes to consume the batches
+    with _query_seconds.time():
+        async with aclosing(iter_changeset_docs(from_, to, tags, after)) as docs:
+            async for doc in docs:
+                batch.append(doc)
+                count += 1
+
+                if len(batch) >= batch_size:
+                    yield await _add_user_info(batch)
+                    batch = []
+
+                if count == limit:
+                    break
+
+        if batch:
+            yield await _add_user_info(batch)
+
+    _queried_changesets.inc(count)
+
+
+def _top_tag_values_facet(key: str, top: int) -> list[dict]:
+    return [
+        {'$unwind': '$t'},
+        {'$match': {'t.k': key}},
+        {'$group': {'_id': '$t.v', 'changesets': {'$sum': 1}, 'num_changes': {'$sum': '$n'}}},
+        {'$sort': {'changesets': pymongo.DESCENDING, '_id': pymongo.ASCENDING}},
+        {'$limit': top},
+        {'$project': {'_id': False, 'value': '$_id', 'changesets': True, 'num_changes': True}},
+    ]
+
+
+async def summarize_changesets(
+    from_: datetime,
+    to: datetime,
+    tags: Sequence[str],
+    *,
+    top: int = 25,
+) -> dict:
+    """
+    Summarize the changesets matched by query_changesets, without transferring them.
+
+    Each collection is filtered by its own indexed $match, and all groupings are computed in a single $facet stage.
+    """
+    legacy_query, query = _match_queries(from_, to, tags)
+    pipelines = []
+
+    for collection, is_legacy in await _get_collections(from_, to):
+        if is_legacy:
+            pipeline = [
+                {'$match': legacy_query},
+                {
+                    '$project': {
+                        '_id': '$@id',
+                        'u': '$@uid',
+                        'n': '$@num_changes',
+                        'c': '$@closed_at',
+                        't': {
+                            '$filter': {
+                                'input': {'$objectToArray': '$tags'},
+                                'cond': {'$ne': ['$$this.k', '__empty__']},
+                            }
+                        },
+                    }
+                },
+            ]
+        else:
+            pipeline = [{'$match': query}, {'$project': {'u': True, 'n': True, 'c': True, 't': True}}]
+
+        pipelines.append((collection, pipeline))
+
+    histogram_unit = 'hour' if to - from_ <= timedelta(days=7) else 'day'
+    result = {
+        'changesets': 0,
+        'num_changes': 0,
+        'users': 0,
+        'first_closed_at': None,
+        'last_closed_at': None,
+        'histogram_unit': histogram_unit,
+        'histogram': [],
+        'top_users': [],
+        'top_created_by': [],
+        'top_comments': [],
+    }
+
+    if not pipelines:
+        return result
 
-        query['$and'] = [{k: v} for k, v in tag_query.items()]
+    # while migrating, a changeset may be briefly stored twice: keep the copy of the latest collection,
+    # the migration target, whatever order $unionWith returns the documents in
+    if dedupe := len(pipelines) > 1 and not await is_migrated():
+        pipelines = [(c, [*p, {'$addFields': {'_p': i}}]) for i, (c, p) in enumerate(pipelines)]
+
+    collection, pipeline = _union_pipeline(pipelines)
+
+    if dedupe:
+        pipeline.append({'$sort': {'_id': pymongo.ASCENDING, '_p': pymongo.ASCENDING}})
+        pipeline.append({'$group': {'_id': '$_id', 'doc': {'$last': '$$ROOT'}}})
+        pipeline.append({'$replaceWith': '$doc'})
+        pipeline.append({'$unset': '_p'})
+
+    pipeline.append(
+        {
+            '$facet': {
+                'totals': [
+                    {
+                        '$group': {
+                            '_id': None,
+                            'changesets': {'$sum': 1},
+                            'num_changes': {'$sum': '$n'},
+                            'first_closed_at': {'$min': '$c'},
+                            'last_closed_at': {'$max': '$c'},
+                        }
+                    },
+                ],
+                'users': [
+                    {'$group': {'_id': '$u'}},
+                    {'$count': 'users'},
+                ],
+                'histogram': [
+                    {
+                        '$group': {
+                            '_id': {'$dateTrunc': {'date': '$c', 'unit': histogram_unit}},
+                            'changesets': {'$sum': 1},
+                            'num_changes': {'$sum': '$n'},
+                        }
+                    },
+                    {'$sort': {'_id': pymongo.ASCENDING}},
+                    {'$project': {'_id': False, 'start': '$_id', 'changesets': True, 'num_changes': True}},
+                ],
+                'top_users': [
+                    {
+                        '$group': {
+                            '_id': '$u',
+                            'changesets': {'$sum': 1},
+                            'num_changes': {'$sum': '$n'},
+                            'first_closed_at': {'$min': '$c'},
+                            'last_closed_at': {'$max': '$c'},
+                        }
+                    },
+                    {'$sort': {'changesets': pymongo.DESCENDING, '_id': pymongo.ASCENDING}},
+                    {'$limit': top},
+                    {
+                        '$project': {
+                            '_id': False,
+                            'uid': '$_id',
+                            'changesets': True,
+                            'num_changes': True,
+                            'first_closed_at': True,
+                            'last_closed_at': True,
+                        }
+                    },
+                ],
+                'top_created_by': _top_tag_values_facet('created_by', top),
+                'top_comments': _top_tag_values_facet('comment', top),
+            }
+        }
+    )
 
-    cursor = CHANGESET_COLLECTION.find(query, projection={'_id': False}).sort('@id', pymongo.ASCENDING)
+    with span('summarize_changesets'):
+        facets = await collection.aggregate(pipeline, allowDiskUse=True).next()
 
-    result = {}
-    result_uids = set()
+    if facets['totals']:
+        totals = facets['totals'][0]
+        del totals['_id']
+        result |= totals
 
-    async for doc in cursor:
-        result[doc['@id']] = doc
-        result_uids.add(doc['@uid'])
+    if facets['users']:
+        result['users'] = facets['users'][0]['users']
+
+    result['histogram'] = facets['histogram']
+    result['top_created_by'] = facets['top_created_by']
+    result['top_comments'] = facets['top_comments']
+
+    top_users = facets['top_users']
 
-    with print_run_time('Fetching latest user info'):
-        latest_user_info = await _fetch_latest_user_info(result_uids)
+    with span('latest_user_info'):
+        latest_user_info = await get_latest_user_info([user['uid'] for user in top_users])
 
-    for doc in result.values():
-        doc['user'] = latest_user_info[doc['@uid']]
+    for user in top_users:
+        user_info = latest_user_info[user['uid']]
+        user['display_name'] = user_info['display_name'] if user_info is not None else None
+        user['blocked'] = user_info is not None and user_info['blocks']['received']['active'] > 0
 
+    result['top_users'] = top_users
     return result
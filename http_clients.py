@@ -0,0 +1,92 @@
+"""
+Long-lived HTTP clients, one connection pool per upstream, opened by the application lifespan.
+
+The clients are shared by all users, so they store no cookies.
+
+Connection reuse is measured with the httpcore trace extension: every request is counted,
+and so is every new TCP connection. The difference is the number of reused connections.
+"""
+
+from collections.abc import AsyncGenerator
+from contextlib import AsyncExitStack, asynccontextmanager
+from dataclasses import asdict, dataclass
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+
+import httpx
+
+from config import (
+    HTTP2,
+    HTTP_KEEPALIVE_EXPIRY,
+    HTTP_MAX_CONNECTIONS,
+    HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_TIMEOUT,
+    OSM_API_URL,
+    OSM_PLANET_URL,
+)
+from utils import get_http_client
+
+
+@dataclass(kw_only=True, slots=True)
+class UpstreamStats:
+    requests: int = 0
+    connections: int = 0
+
+    @property
+    def reused(self) -> int:
+        return self.requests - self.connections
+
+
+_clients: dict[str, httpx.AsyncClient] = {}
+_stats: dict[str, UpstreamStats] = {}
+
+
+def _create_client(upstream: str, base_url: str) -> httpx.AsyncClient:
+    stats = _stats.setdefault(upstream, UpstreamStats())
+
+    async def trace(event_name: str, _: dict) -> None:
+        if event_name == 'connection.connect_tcp.complete':
+            stats.connections += 1
+
+    async def on_request(request: httpx.Request) -> None:
+        stats.requests += 1
+        request.extensions['trace'] = trace
+
+    return get_http_client(
+        base_url,
+        http2=HTTP2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY.total_seconds(),
+        ),
+        timeout=httpx.Timeout(HTTP_TIMEOUT.total_seconds(), connect=10),
+        event_hooks={'request': [on_request]},
+        # shared by the requests of all users: never keep a session cookie from one of them
+        cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+    )
+
+
+@asynccontextmanager
+async def http_clients_lifespan() -> AsyncGenerator[None, None]:
+    async with AsyncExitStack() as stack:
+        _clients['api'] = await stack.enter_async_context(_create_client('api', OSM_API_URL))
+        _clients['planet'] = await stack.enter_async_context(_create_client('planet', OSM_PLANET_URL))
+
+        try:
+            yield
+        finally:
+            _clients.clear()
+
+
+def get_api_client() -> httpx.AsyncClient:
+    """Client for api.openstreetmap.org, relative to /api/0.6/."""
+    return _clients['api']
+
+
+def get_planet_client() -> httpx.AsyncClient:
+    """Client for planet.openstreetmap.org, also used for the replication files."""
+    return _clients['planet']
+
+
+def get_http_stats() -> dict[str, dict]:
+    return {upstream: asdict(stats) | {'reused': stats.reused} for upstream, stats in _stats.items()}
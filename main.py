@@ -1,24 +1,53 @@
+from collections.abc import AsyncGenerator, AsyncIterator
 from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
-from queue import Queue
 from typing import Annotated
 
 import anyio
+import jinja2
 import orjson
 from authlib.integrations.httpx_client import AsyncOAuth2Client
-from fastapi import Depends, FastAPI, Form, HTTPException, Request, status
-from fastapi.responses import ORJSONResponse, RedirectResponse
+from fastapi import Depends, FastAPI, Form, Header, HTTPException, Query, Request, status
+from fastapi.responses import ORJSONResponse, PlainTextResponse, RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
-
-from config import DRY_RUN, LOGS_QUEUE_SIZE, OSM_CLIENT, OSM_SCOPES, OSM_SECRET, SECRET, USER_AGENT
+from starlette.types import Receive, Scope, Send
+
+from changeset_buckets import setup_buckets
+from changeset_migration import migrate_changesets
+from changeset_time_range import get_changesets_time_range
+from config import (
+    CHANGESETS_PAGE_SIZE,
+    DRY_RUN,
+    OSM_CLIENT,
+    OSM_SCOPES,
+    OSM_SECRET,
+    REVERT_STORE_SHUTDOWN_TIMEOUT,
+    SECRET,
+    USER_AGENT,
+)
 from config_db import setup_mongo
-from filter import get_changesets_time_range, get_specific_changesets_time_range, query_changesets
+from deleted_users import run_deleted_users_refresher
+from filter import (
+    get_changesets_info,
+    get_specific_changesets_time_range,
+    query_changesets,
+    summarize_changesets,
+)
+from http_clients import get_http_stats, http_clients_lifespan
+from metrics import expose_metrics, remove_metrics_snapshot, run_metrics_writer
 from replication_worker import ReplicationWorker
+from revert_events import export_task_events, stream_task_events
+from revert_grouping import RevertGrouping, group_changesets
 from revert_manager import RevertManager
-from revert_task import RevertTask
+from revert_pool import revert_pool
+from revert_store import revert_store
+from revert_task import ChangesetStatus, RevertOutcome, RevertTask
 from states.worker_state import WorkerStateEnum, get_worker_state
+from task_log import EventLevel, TaskLog
+from tracing import TracingMiddleware, run_trace_exporter, span
+from user_info import run_user_info_refresher
 from user_session import (
     fetch_user_details,
     is_whitelisted,
@@ -27,7 +56,7 @@ from user_session import (
     set_oauth_token,
     unset_oauth_token,
 )
-from utils import datetime_isoformat, print_run_time, tojson_orjson
+from utils import datetime_isoformat, tojson_orjson
 
 INDEX_REDIRECT = RedirectResponse('/', status_code=status.HTTP_303_SEE_OTHER)
 
@@ -45,31 +74,78 @@ async def lifespan(_: FastAPI):
 
     if worker_state.is_primary:
         await setup_mongo()
-        async with anyio.create_task_group() as tg:
+        await setup_buckets()
+    else:
+        await worker_state.wait_for_state(WorkerStateEnum.RUNNING)
+
+    async with http_clients_lifespan(), anyio.create_task_group() as tg:
+        tg.start_soon(run_user_info_refresher)
+        tg.start_soon(run_metrics_writer)
+        tg.start_soon(run_trace_exporter)
+
+        if worker_state.is_primary:
             revert_manager = RevertManager(tg)
+            await revert_manager.resume()
 
+            tg.start_soon(revert_store.run)
             tg.start_soon(replication_worker.run)
+            tg.start_soon(migrate_changesets)
+            tg.start_soon(run_deleted_users_refresher)
 
             await worker_state.set_state(WorkerStateEnum.RUNNING)
-            yield
 
-            # on shutdown, always abort the tasks
-            tg.cancel_scope.cancel()
-    else:
-        await worker_state.wait_for_state(WorkerStateEnum.RUNNING)
         yield
 
+        # on shutdown, always abort the tasks
+        tg.cancel_scope.cancel()
+
+    if worker_state.is_primary:
+        # interrupted changesets stay running, and are reverted again after the restart
+        with anyio.move_on_after(REVERT_STORE_SHUTDOWN_TIMEOUT.total_seconds()) as scope:
+            await revert_store.flush()
+
+        if scope.cancelled_caught:
+            print('[REVERT] Timed out writing the revert tasks, the latest progress is lost')
+
+    revert_pool.close()
+    remove_metrics_snapshot()
+
 
 app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 app.add_middleware(SessionMiddleware, secret_key=SECRET, max_age=2 * 365 * 24 * 3600, same_site='strict')  # 2 years
+app.add_middleware(TracingMiddleware)
 app.mount('/static', StaticFiles(directory='static'), name='static')
 
+
+class _TracedTemplate(jinja2.Template):
+    def render(self, *args, **kwargs) -> str:
+        with span('render', template=self.name):
+            return super().render(*args, **kwargs)
+
+
 templates = Jinja2Templates(directory='templates')
+templates.env.template_class = _TracedTemplate
 templates.env.globals['datetime_isoformat'] = datetime_isoformat
 templates.env.globals['timedelta'] = timedelta
+templates.env.globals['RevertOutcome'] = RevertOutcome
 templates.env.globals['tojson_orjson'] = tojson_orjson
 
 
+class _ClosingStreamingResponse(StreamingResponse):
+    """Closes `source` once the response ends, even if the client disconnected before the body was iterated."""
+
+    def __init__(self, content: AsyncIterator[bytes], *, source: AsyncGenerator, **kwargs) -> None:
+        super().__init__(content, **kwargs)
+        self._source = source
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self._source.aclose()
+
+
 @app.get('/')
 async def index(
     request: Request,
@@ -84,6 +160,7 @@ async def index(
                     'user': user,
                     'time_range': await get_changesets_time_range(),
                     'tasks': revert_manager.get_all(ascending=False),
+                    'scheduler': revert_manager.scheduler,
                 },
             )
         else:
@@ -106,19 +183,79 @@ async def classify(
     else:
         tags = ()
 
-    with print_run_time('Querying changesets'):
-        changesets = await query_changesets(from_, to, tags)
-
     return templates.TemplateResponse(
         'classify.jinja2',
         {
             'request': request,
             'user': user,
-            'changesets': changesets,
+            'query': {
+                'from_': datetime_isoformat(from_, 'seconds'),
+                'to': datetime_isoformat(to, 'seconds'),
+                'tags': tags,
+                'limit': CHANGESETS_PAGE_SIZE,
+            },
         },
     )
 
 
+@app.get('/api/changesets')
+async def get_changesets(
+    from_: datetime,
+    to: datetime,
+    tags: Annotated[list[str], Query()] = [],  # noqa: B006
+    after: int = 0,
+    limit: Annotated[int, Query(gt=0, le=CHANGESETS_PAGE_SIZE)] = CHANGESETS_PAGE_SIZE,
+    user=Depends(require_whitelisted),
+):
+    """
+    Stream matching changesets as NDJSON, in ascending id order.
+
+    Pages are keyed by changeset id: pass the last received id as `after`.
+    A page with less than `limit` changesets is the last one.
+    """
+
+    batches = query_changesets(from_, to, tags, after=after, limit=limit)
+
+    # the first batch is queried before the headers are sent, so that Server-Timing breaks down its time
+    with span('query_changesets'):
+        first_batch = await anext(batches, None)
+
+    async def generate():
+        if first_batch is None:
+            return
+
+        yield b''.join(orjson.dumps(changeset) + b'\n' for changeset in first_batch)
+
+        with span('query_changesets'):
+            async for batch in batches:
+                yield b''.join(orjson.dumps(changeset) + b'\n' for changeset in batch)
+
+    return _ClosingStreamingResponse(generate(), source=batches, media_type='application/x-ndjson')
+
+
+@app.get('/api/changesets/summary')
+async def get_changesets_summary(
+    from_: datetime,
+    to: datetime,
+    tags: Annotated[list[str], Query()] = [],  # noqa: B006
+    user=Depends(require_whitelisted),
+):
+    """Summarize the changesets matched by /api/changesets: per-user, per-tag and time histogram groupings."""
+    return ORJSONResponse(await summarize_changesets(from_, to, tags))
+
+
+@app.get('/api/http-stats')
+async def get_http_stats_(_=Depends(require_whitelisted)):
+    """Requests and connection reuse per upstream, in this worker process."""
+    return get_http_stats()
+
+
+@app.get('/metrics')
+async def get_metrics():
+    """Metrics of all worker processes, in the Prometheus text format."""
+    return PlainTextResponse(await expose_metrics(), media_type='text/plain; version=0.0.4')
+
+
 @app.post('/configure')
 async def configure(
     request: Request,
@@ -131,6 +268,11 @@ async def configure(
     if not changesets:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, 'No changesets specified')
 
+    time_range = await get_specific_changesets_time_range(changesets)
+
+    if time_range[0] is None:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, 'None of the changesets are known')
+
     return templates.TemplateResponse(
         'configure.jinja2',
         {
@@ -138,7 +280,7 @@ async def configure(
             'user': user,
             'changesets_encoded': changesets_encoded,
             'changesets': changesets,
-            'time_range': await get_specific_changesets_time_range(changesets),
+            'time_range': time_range,
         },
     )
 
@@ -154,6 +296,10 @@ async def post_revert(
     revert_to_date: Annotated[datetime | None, Form()] = None,
     only_tags: Annotated[str | None, Form()] = None,
     iterator_delay: Annotated[str | None, Form()] = None,
+    grouping: Annotated[RevertGrouping, Form()] = RevertGrouping.NONE,
+    group_size: Annotated[int, Form(ge=1, le=1000)] = 50,
+    priority: Annotated[int, Form(ge=1, le=4)] = 2,
+    passes: Annotated[int, Form(ge=1, le=5)] = 1,
     oauth_token=Depends(require_oauth_token),
     user=Depends(require_whitelisted),
 ):
@@ -169,6 +315,10 @@ async def post_revert(
     discussion = discussion.strip() if discussion else ''
 
     time_range = await get_specific_changesets_time_range(changesets)
+
+    if time_range[0] is None:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, 'None of the changesets are known')
+
     envs = {}
 
     if revert_to_date:
@@ -203,23 +353,38 @@ async def post_revert(
     if DRY_RUN:
         options['print_osc'] = True
 
+    if grouping != RevertGrouping.NONE:
+        changesets_info = await get_changesets_info(changesets)
+    else:
+        changesets_info = {}
+
+    groups = group_changesets(changesets, changesets_info, grouping=grouping, group_size=group_size)
+
     task = RevertTask(
         id=datetime_isoformat(datetime.utcnow(), 'seconds'),
         changesets=changesets,
+        groups=groups,
+        grouping=grouping,
         time_range=time_range,
         envs=envs,
         hidden_options=hidden_options,
         options=options,
-        passes=1,
+        passes=passes,
+        current_pass=1,
+        statuses=dict.fromkeys(changesets, ChangesetStatus.PENDING),
+        outcomes={},
         progress=0,
-        logs=Queue(maxsize=LOGS_QUEUE_SIZE),
+        logs=TaskLog(),
         iterator_delay=timedelta(minutes=iterator_delay),
         parallel=bool(revert_to_date) and not iterator_delay,
+        concurrency=0,
+        priority=priority,
+        queued=True,
         aborted=False,
         finished=False,
     )
 
-    revert_manager.submit(task)
+    await revert_manager.submit(task)
     return RedirectResponse(f'/revert/{task.id}', status_code=status.HTTP_303_SEE_OTHER)
 
 
@@ -239,12 +404,56 @@ async def get_revert(
         {
             'request': request,
             'user': user,
-            'time_range': await get_specific_changesets_time_range(task.changesets),
+            'time_range': task.time_range,
             'task': task,
         },
     )
 
 
+@app.get('/revert/{id}/events')
+async def get_revert_events(
+    id: str,
+    after: int = 0,
+    last_event_id: Annotated[int | None, Header()] = None,
+    user=Depends(require_whitelisted),
+):
+    """Stream the new log lines and the state changes of the task as server-sent events."""
+    task = revert_manager.get_by_id(id)
+
+    if task is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Task not found')
+
+    # sent by EventSource when reconnecting
+    if last_event_id is not None:
+        after = last_event_id
+
+    return StreamingResponse(
+        stream_task_events(task, after),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
+
+
+@app.get('/revert/{id}/events.ndjson')
+async def get_revert_events_export(
+    id: str,
+    changeset_id: int | None = None,
+    level: EventLevel = EventLevel.DEBUG,
+    user=Depends(require_whitelisted),
+):
+    """Export the structured log of the task, optionally only the events of a changeset or from a level up."""
+    task = revert_manager.get_by_id(id)
+
+    if task is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, 'Task not found')
+
+    return StreamingResponse(
+        export_task_events(task, changeset_id=changeset_id, min_level=level),
+        media_type='application/x-ndjson',
+        headers={'Content-Disposition': f'attachment; filename="thanos-{id}.ndjson"'},
+    )
+
+
 @app.post('/revert/{id}/abort')
 async def post_revert_abort(
     request: Request,
@@ -261,7 +470,7 @@ async def post_revert_delete(
     id: str,
     user=Depends(require_whitelisted),
 ):
-    revert_manager.delete_by_id(id)
+    await revert_manager.delete_by_id(id)
     return INDEX_REDIRECT
 
 
@@ -0,0 +1,235 @@
+"""
+Counters, gauges and histograms, exposed at /metrics in the Prometheus text format.
+
+Updating a metric only touches a dict in the current process. Every uvicorn worker periodically writes
+its values to a snapshot file, /tmp/{NAME}-metrics-{pid}.json, and a scrape of any worker merges the
+snapshots of all live workers by summing them. Gauges are summed too, so a gauge set by the primary
+worker alone, like the replication lag, keeps its value.
+"""
+
+import math
+import os
+import time
+from bisect import bisect_left
+from collections.abc import Iterator, Sequence
+from contextlib import contextmanager
+from pathlib import Path
+
+import anyio
+import orjson
+import psutil
+from anyio import to_thread
+
+from config import METRICS_SNAPSHOT_INTERVAL, NAME
+
+_SNAPSHOT_DIR = Path('/tmp')
+_SNAPSHOT_PREFIX = f'{NAME}-metrics-'
+
+# seconds, from fast Mongo writes to slow osm_revert jobs
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_registry: dict[str, '_Metric'] = {}
+
+
+class _Metric:
+    type = ''
+
+    __slots__ = ('_values', 'help', 'labelnames', 'name')
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:  # noqa: A002
+        assert name not in _registry, f'Metric {name!r} is already registered'
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values: dict[tuple[str, ...], float | list[float]] = {}
+        _registry[name] = self
+
+    def _key(self, labels: dict[str, object]) -> tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key: Sequence[str], extra: str = '') -> str:
+        pairs = [f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, key, strict=True)]
+
+        if extra:
+            pairs.append(extra)
+
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def snapshot(self) -> list:
+        # called on the event loop: the copies are handed to a worker thread, while the live values keep changing
+        return [[list(key), value.copy() if isinstance(value, list) else value] for key, value in self._values.items()]
+
+    def expose(self, values: dict[tuple[str, ...], float | list[float]]) -> Iterator[str]:
+        for key, value in values.items():
+            yield f'{self.name}{self._format_labels(key)} {_format_value(value)}'
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    __slots__ = ()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    __slots__ = ()
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    __slots__ = ('buckets',)
+
+    def __init__(
+        self,
+        name: str,
+        help: str,  # noqa: A002
+        labelnames: Sequence[str] = (),
+        *,
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> None:
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+
+        # non-cumulative bucket counts, then +Inf, sum
+        if state is None:
+            state = self._values[key] = [0] * (len(self.buckets) + 2)
+
+        state[bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        ts = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - ts, **labels)
+
+    def expose(self, values: dict[tuple[str, ...], float | list[float]]) -> Iterator[str]:
+        for key, state in values.items():
+            cumulative = 0
+
+            for bound, count in zip((*self.buckets, math.inf), state, strict=False):
+                cumulative += count
+                le = '+Inf' if bound == math.inf else _format_value(bound)
+                labels = self._format_labels(key, f'le="{le}"')
+                yield f'{self.name}_bucket{labels} {_format_value(cumulative)}'
+
+            yield f'{self.name}_sum{self._format_labels(key)} {_format_value(state[-1])}'
+            yield f'{self.name}_count{self._format_labels(key)} {_format_value(cumulative)}'
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _snapshot_path(pid: int) -> Path:
+    return _SNAPSHOT_DIR / f'{_SNAPSHOT_PREFIX}{pid}.json'
+
+
+def _snapshot() -> dict:
+    # must run on the event loop, which is the only writer of the values
+    return {name: metric.snapshot() for name, metric in _registry.items()}
+
+
+def _write_snapshot(snapshot: dict) -> None:
+    path = _snapshot_path(os.getpid())
+    tmp_path = path.with_suffix('.tmp')
+    tmp_path.write_bytes(orjson.dumps(snapshot))
+    tmp_path.replace(path)
+
+
+def remove_metrics_snapshot() -> None:
+    _snapshot_path(os.getpid()).unlink(missing_ok=True)
+
+
+def _merge(values: dict[tuple[str, ...], float | list[float]], key: tuple[str, ...], value: float | list) -> None:
+    current = values.get(key)
+
+    if current is None:
+        values[key] = value
+    elif isinstance(value, list):
+        values[key] = [a + b for a, b in zip(current, value, strict=True)]
+    else:
+        values[key] = current + value
+
+
+def _read_snapshots() -> dict[str, dict[tuple[str, ...], float | list[float]]]:
+    merged: dict[str, dict[tuple[str, ...], float | list[float]]] = {name: {} for name in _registry}
+
+    for path in _SNAPSHOT_DIR.glob(f'{_SNAPSHOT_PREFIX}*.json'):
+        pid = int(path.stem.removeprefix(_SNAPSHOT_PREFIX))
+
+        # left behind by a killed worker
+        if not psutil.pid_exists(pid):
+            path.unlink(missing_ok=True)
+            continue
+
+        try:
+            snapshot = orjson.loads(path.read_bytes())
+        except (FileNotFoundError, orjson.JSONDecodeError):
+            continue
+
+        for name, entries in snapshot.items():
+            values = merged.get(name)
+
+            # registered by a newer version of the code
+            if values is None:
+                continue
+
+            for key, value in entries:
+                _merge(values, tuple(key), value)
+
+    return merged
+
+
+def _expose(snapshot: dict) -> str:
+    _write_snapshot(snapshot)
+    lines = []
+
+    for name, values in _read_snapshots().items():
+        metric = _registry[name]
+        lines.append(f'# HELP {name} {metric.help}')
+        lines.append(f'# TYPE {name} {metric.type}')
+        lines.extend(metric.expose(values))
+
+    return '\n'.join(lines) + '\n'
+
+
+async def expose_metrics() -> str:
+    """Return the metrics of all workers in the Prometheus text format."""
+    return await to_thread.run_sync(_expose, _snapshot())
+
+
+async def run_metrics_writer() -> None:
+    while True:
+        await to_thread.run_sync(_write_snapshot, _snapshot())
+        await anyio.sleep(METRICS_SNAPSHOT_INTERVAL.total_seconds())
+
+
+mongo_write_seconds = Histogram('thanos_mongo_write_seconds', 'Duration of batched Mongo writes.', ('operation',))
@@ -1,18 +1,38 @@
-import gzip
+import zlib
 from collections.abc import Sequence
 from datetime import UTC, datetime, timedelta
 
 import anyio
-import xmltodict
 import yaml
 from httpx import AsyncClient
-from pymongo import UpdateOne
 
-from config import CHANGESET_MAX_AGE, REPLICATION_FREQUENCY, REPLICATION_SLEEP, REPLICATION_URL
-from config_db import CHANGESET_COLLECTION
+from changeset_buckets import drop_expired_buckets
+from changeset_buffer import ChangesetIngestBuffer
+from changeset_dump import load_changeset_dump
+from changeset_migration import is_migrated
+from changeset_parser import ChangesetParser
+from changeset_time_range import refresh_changesets_time_range
+from config import (
+    CHANGESET_DUMP_PATH,
+    CHANGESET_MAX_AGE,
+    REPLICATION_FREQUENCY,
+    REPLICATION_PREFETCH,
+    REPLICATION_SLEEP,
+    REPLICATION_URL,
+)
+from config_db import LEGACY_CHANGESET_COLLECTION, UNPARTITIONED_CHANGESET_COLLECTION
+from http_clients import get_planet_client
+from metrics import Counter, Gauge, Histogram
 from state import get_state_doc, set_state_doc
-from utils import get_http_client, retry_exponential
-from xmltodict_postprocessor import xmltodict_postprocessor
+from utils import retry_exponential
+
+_replication_sequence = Gauge('thanos_replication_sequence', 'Last downloaded replication sequence.')
+_replication_lag = Gauge('thanos_replication_lag_seconds', 'Age of the newest changeset of the last sequence.')
+_replication_changesets = Counter('thanos_replication_changesets_total', 'Changesets downloaded from replication.')
+_replication_download_seconds = Histogram(
+    'thanos_replication_download_seconds',
+    'Duration of downloading and parsing a replication sequence.',
+)
 
 
 def _format_sequence_number(sequence_number: int) -> str:
@@ -21,43 +41,60 @@ def _format_sequence_number(sequence_number: int) -> str:
     return result
 
 
-async def _get_last_replication_id() -> int:
-    doc = await get_state_doc('replication')
+async def _get_remote_replication_id(http: AsyncClient) -> int:
+    r = await http.get(f'{REPLICATION_URL}state.yaml')
+    r.raise_for_status()
 
-    if doc is not None:
-        return doc['last_replication_id']
+    remote_state = yaml.safe_load(r.text)
+    return remote_state['sequence']
 
-    async with get_http_client(REPLICATION_URL) as http:
-        r = await http.get('state.yaml')
+
+async def _find_replication_id(http: AsyncClient, target_date: datetime) -> int:
+    remote_sequence_number = await _get_remote_replication_id(http)
+    local_date = datetime.utcnow().replace(tzinfo=UTC)
+    current_sequence_number = remote_sequence_number - int((local_date - target_date) / REPLICATION_FREQUENCY)
+
+    while True:
+        print(f'[REPL] Synchronizing sequence: {current_sequence_number}')
+
+        r = await http.get(f'{REPLICATION_URL}{_format_sequence_number(current_sequence_number)}.state.txt')
         r.raise_for_status()
 
-        remote_state = yaml.safe_load(r.text)
-        remote_sequence_number = remote_state['sequence']
-        current_sequence_number = remote_sequence_number - int(CHANGESET_MAX_AGE / REPLICATION_FREQUENCY)
+        sequence_state = yaml.safe_load(r.text)
+        sequence_date = sequence_state['last_run']
+        sequence_time_to_target = target_date - sequence_date
 
-        local_date = datetime.utcnow().replace(tzinfo=UTC)
+        if sequence_time_to_target < timedelta():
+            break
 
-        while True:
-            print(f'[REPL] Synchronizing sequence: {current_sequence_number}')
+        sequence_step_to_target = sequence_time_to_target / REPLICATION_FREQUENCY
 
-            r = await http.get(f'{_format_sequence_number(current_sequence_number)}.state.txt')
-            r.raise_for_status()
+        if sequence_step_to_target > 10:
+            current_sequence_number += int(sequence_step_to_target / 2)
+        else:
+            current_sequence_number += 1
 
-            sequence_state = yaml.safe_load(r.text)
-            sequence_date = sequence_state['last_run']
-            sequence_time_to_target = (local_date - sequence_date) - CHANGESET_MAX_AGE
+    return current_sequence_number
 
-            if sequence_time_to_target < timedelta():
-                break
 
-            sequence_step_to_target = sequence_time_to_target / REPLICATION_FREQUENCY
+async def _get_last_replication_id() -> int:
+    doc = await get_state_doc('replication')
+
+    if doc is not None:
+        return doc['last_replication_id']
+
+    http = get_planet_client()
 
-            if sequence_step_to_target > 10:
-                current_sequence_number += int(sequence_step_to_target / 2)
-            else:
-                current_sequence_number += 1
+    if CHANGESET_DUMP_PATH:
+        dump_date = await load_changeset_dump(CHANGESET_DUMP_PATH)
 
-        return current_sequence_number
+        # replay a small overlap, changesets are upserted so this is harmless
+        repl_id = await _find_replication_id(http, dump_date - timedelta(hours=1))
+        await _set_last_replication_id(repl_id)
+        return repl_id
+
+    local_date = datetime.utcnow().replace(tzinfo=UTC)
+    return await _find_replication_id(http, local_date - CHANGESET_MAX_AGE)
 
 
 async def _set_last_replication_id(repl_id: int):
@@ -66,45 +103,110 @@ async def _set_last_replication_id(repl_id: int):
 
 @retry_exponential(None)
 async def _download_changesets(http: AsyncClient, repl_id: int) -> Sequence[dict] | None:
-    r = await http.get(f'{_format_sequence_number(repl_id)}.osm.gz')
+    with _replication_download_seconds.time():
+        async with http.stream('GET', f'{REPLICATION_URL}{_format_sequence_number(repl_id)}.osm.gz') as r:
+            # not found is expected
+            if r.status_code == 404:
+                return None
 
-    # not found is expected
-    if r.status_code == 404:
-        return None
+            r.raise_for_status()
 
-    r.raise_for_status()
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)  # gzip container
+            parser = ChangesetParser()
+            changesets = []
 
-    compressed = await r.aread()
-    xml = gzip.decompress(compressed).decode()
-    json = xmltodict.parse(
-        xml,
-        postprocessor=xmltodict_postprocessor,
-        force_list=('changeset', 'action', 'node', 'way', 'relation', 'member', 'tag', 'nd'),
-    )
+            async for chunk in r.aiter_bytes():
+                changesets.extend(parser.feed(decompressor.decompress(chunk)))
 
-    changesets = json['osm'].get('changeset', [])
-    changesets = tuple(c for c in changesets if c['@comments_count'] == 0 and c['@num_changes'] > 0 and not c['@open'])
+            changesets.extend(parser.feed(decompressor.flush()))
+            changesets.extend(parser.close())
 
-    for c in changesets:
-        if 'tag' in c:
-            c['tags'] = {tag['@k']: tag['@v'] for tag in c['tag']}
-            del c['tag']
+    return changesets
 
-        # make empty tags easily searchable
-        else:
-            c['tags'] = {'__empty__': '1'}
 
-    return changesets
+async def _cleanup_expired_changesets() -> None:
+    expired_date = datetime.utcnow() - CHANGESET_MAX_AGE
+    changed = await drop_expired_buckets(expired_date) > 0
 
+    if not await is_migrated():
+        legacy = await LEGACY_CHANGESET_COLLECTION.delete_many({'@closed_at': {'$lt': expired_date}})
+        unpartitioned = await UNPARTITIONED_CHANGESET_COLLECTION.delete_many({'c': {'$lt': expired_date}})
+        changed = changed or legacy.deleted_count > 0 or unpartitioned.deleted_count > 0
 
-async def _save_changesets(changesets: Sequence[dict]) -> None:
-    bulk_write_args = [UpdateOne({'@id': cs['@id']}, {'$set': cs}, upsert=True) for cs in changesets]
-    if bulk_write_args:
-        await CHANGESET_COLLECTION.bulk_write(bulk_write_args, ordered=False)
+    # new changesets extend the range as they come, only removals need a full refresh
+    if changed:
+        await refresh_changesets_time_range()
 
 
-async def _cleanup_expired_changesets() -> None:
-    await CHANGESET_COLLECTION.delete_many({'@closed_at': {'$lt': datetime.utcnow() - CHANGESET_MAX_AGE}})
+async def _process_changesets(buffer: ChangesetIngestBuffer, repl_id: int, changesets: Sequence[dict]) -> None:
+    print(f'[REPL][{repl_id}] Downloaded {len(changesets)} changesets')
+    _replication_sequence.set(repl_id)
+    _replication_changesets.inc(len(changesets))
+
+    if changesets:
+        lag = datetime.utcnow() - max(changeset['c'] for changeset in changesets)
+        _replication_lag.set(lag.total_seconds())
+
+    buffer.add(repl_id, changesets)
+
+    if buffer.should_flush():
+        await buffer.flush()
+
+
+class _Prefetch:
+    __slots__ = ('changesets', 'event')
+
+    def __init__(self) -> None:
+        self.event = anyio.Event()
+        self.changesets: Sequence[dict] | None = None
+
+
+async def _catch_up(http: AsyncClient, buffer: ChangesetIngestBuffer, repl_id: int) -> int:
+    """
+    Download and parse a window of sequences concurrently, while committing them strictly in order.
+
+    Returns the next sequence to process. Stops at the first missing sequence, so that the replication
+    state never moves past a gap.
+    """
+    remote_id = await _get_remote_replication_id(http)
+
+    # small optimization
+    if remote_id <= repl_id:
+        return repl_id
+
+    print(f'[REPL] Catching up {remote_id - repl_id + 1} sequences ({REPLICATION_PREFETCH} prefetched)')
+    send_stream, recv_stream = anyio.create_memory_object_stream(max_buffer_size=REPLICATION_PREFETCH)
+
+    async with anyio.create_task_group() as tg:
+
+        async def fetch(seq: int, prefetch: _Prefetch) -> None:
+            prefetch.changesets = await _download_changesets(http, seq)
+            prefetch.event.set()
+
+        async def schedule() -> None:
+            async with send_stream:
+                for seq in range(repl_id, remote_id + 1):
+                    prefetch = _Prefetch()
+                    await send_stream.send((seq, prefetch))
+                    tg.start_soon(fetch, seq, prefetch)
+
+        tg.start_soon(schedule)
+
+        async with recv_stream:
+            async for seq, prefetch in recv_stream:
+                seq: int
+                prefetch: _Prefetch
+                await prefetch.event.wait()
+
+                if prefetch.changesets is None:
+                    print(f'[REPL][{seq}] Sequence is missing, stopping catch-up')
+                    tg.cancel_scope.cancel()
+                    break
+
+                await _process_changesets(buffer, seq, prefetch.changesets)
+                repl_id = seq + 1
+
+    return repl_id
 
 
 class ReplicationWorker:
@@ -113,20 +215,28 @@ class ReplicationWorker:
         last_replication_id = await _get_last_replication_id()
         repl_id = last_replication_id + 1
         is_synchronized = False
+        buffer = await ChangesetIngestBuffer.create()
 
-        async with get_http_client(REPLICATION_URL) as http:
-            while True:
-                if is_synchronized:
-                    await _cleanup_expired_changesets()
-                    await anyio.sleep(REPLICATION_SLEEP.total_seconds())
+        http = get_planet_client()
 
-                changesets = await _download_changesets(http, repl_id)
-
-                if changesets is None:
-                    is_synchronized = True
-                    continue
-
-                print(f'[REPL][{repl_id}] Downloaded {len(changesets)} changesets')
-                await _save_changesets(changesets)
-                await _set_last_replication_id(repl_id)
-                repl_id += 1
+        while True:
+            if is_synchronized:
+                await _cleanup_expired_changesets()
+                await anyio.sleep(REPLICATION_SLEEP.total_seconds())
+            elif REPLICATION_PREFETCH > 1:
+                repl_id = await _catch_up(http, buffer, repl_id)
+
+            changesets = await _download_changesets(http, repl_id)
+
+            if changesets is None:
+                # flush whatever is left over from catching up
+                await buffer.flush()
+                is_synchronized = True
+                continue
+
+            await _process_changesets(buffer, repl_id, changesets)
+            repl_id += 1
+
+            # keep the latency low once synchronized
+            if is_synchronized:
+                await buffer.flush()
@@ -0,0 +1,71 @@
+import re
+
+import anyio
+
+# osm_revert output hinting that the API is pushing back,
+# status codes only after HTTP or status, a bare number may be an element count
+_CONGESTION_RE = re.compile(
+    r'\b(?:HTTP(?:/[\d.]+)?|status(?: code)?)\W*(?:429|50[234])\b|too many requests|rate.?limit|timed? ?out',
+    re.IGNORECASE,
+)
+
+# a job slower than this multiple of the average duration counts as rising latency
+_LATENCY_FACTOR = 2
+_LATENCY_SMOOTHING = 0.2
+
+
+class ConcurrencyController:
+    """
+    AIMD limit on the number of concurrent revert jobs of a task.
+
+    Each fast, successful job grows the limit by 1/limit, so about one slot per round of jobs.
+    A failed job, a timeout, a congestion hint in its log, or a duration well above the moving
+    average halves the limit. Durations are per changeset, as jobs revert groups of different sizes.
+    The limit stays between 1 and `ceiling`.
+    """
+
+    __slots__ = ('_active', '_average_duration', '_changed', '_limit', 'ceiling')
+
+    def __init__(self, ceiling: int) -> None:
+        self.ceiling = ceiling
+        self._limit = 1.0
+        self._active = 0
+        self._average_duration: float | None = None
+        self._changed: anyio.Event | None = None
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    @staticmethod
+    def is_congestion(line: str) -> bool:
+        return _CONGESTION_RE.search(line) is not None
+
+    def _notify(self) -> None:
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    async def acquire(self) -> None:
+        while self._active >= self.limit:
+            if self._changed is None:
+                self._changed = anyio.Event()
+            await self._changed.wait()
+
+        self._active += 1
+
+    def release(self, *, success: bool, duration: float, congested: bool) -> None:
+        self._active -= 1
+        average = self._average_duration
+
+        if not success or congested or (average is not None and duration > average * _LATENCY_FACTOR):
+            self._limit = max(1.0, self._limit / 2)
+        else:
+            self._limit = min(float(self.ceiling), self._limit + 1 / self._limit)
+
+        if success:
+            self._average_duration = (
+                duration if average is None else average + (duration - average) * _LATENCY_SMOOTHING
+            )
+
+        self._notify()
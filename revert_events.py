@@ -0,0 +1,96 @@
+"""
+Live view of a revert task: its log lines and state, streamed to the revert page as server-sent events.
+
+Log lines are numbered, and a client only receives the lines after the last number it has seen.
+On reconnect, EventSource sends that number back in the Last-Event-ID header. A number past the end
+of the log comes from before a restart: the client then replaces its lines with the current tail.
+
+The full structured log is exported as NDJSON instead.
+"""
+
+from collections.abc import AsyncIterator
+
+import anyio
+import orjson
+
+from revert_task import RevertTask
+from task_log import EventLevel
+
+# state changes without a new log line, like the progress of a silent worker, are picked up this often
+_STATE_POLL_INTERVAL = 1
+
+_EXPORT_CHUNK_SIZE = 1000
+
+
+def get_task_state(task: RevertTask) -> dict:
+    return {
+        'progress': task.progress,
+        'concurrency': task.concurrency,
+        'queued': task.queued,
+        'current_pass': task.current_pass,
+        'outcomes': {outcome.value: count for outcome, count in task.outcome_totals().items()},
+        'duration': round(task.outcomes_duration),
+        'aborted': task.aborted,
+        'finished': task.finished,
+    }
+
+
+def _event(event: str, data: dict, *, id_: int | None = None) -> bytes:
+    result = f'event: {event}\n'.encode()
+
+    if id_ is not None:
+        result += f'id: {id_}\n'.encode()
+
+    return result + b'data: ' + orjson.dumps(data) + b'\n\n'
+
+
+async def stream_task_events(task: RevertTask, after: int) -> AsyncIterator[bytes]:
+    """Yield the log lines after `after`, and every state change, until the task is finished."""
+    seq = after
+    state = None
+
+    # the log of a task resumed after a restart numbers its events from 1 again: resend its tail
+    reset = after > task.logs.last_seq
+
+    if reset:
+        seq = 0
+
+    while True:
+        if (lines := task.logs.lines(after=seq)) or reset:
+            seq = task.logs.last_seq
+            yield _event('log', {'lines': lines, 'reset': reset}, id_=seq)
+            reset = False
+
+        if (new_state := get_task_state(task)) != state:
+            state = new_state
+            yield _event('state', state)
+
+        if task.finished:
+            return
+
+        with anyio.move_on_after(_STATE_POLL_INTERVAL):
+            await task.logs.wait(seq)
+
+
+async def export_task_events(
+    task: RevertTask,
+    *,
+    changeset_id: int | None,
+    min_level: EventLevel,
+) -> AsyncIterator[bytes]:
+    """Yield the matching events as NDJSON, decoding only one chunk of them at a time."""
+    chunk = []
+
+    # events are added while the export is streamed, and the oldest ones may be dropped
+    for seq in tuple(task.logs.select(changeset_id=changeset_id, min_level=min_level)):
+        if seq < task.logs.first_seq:
+            continue
+
+        chunk.append(orjson.dumps(task.logs.get(seq).to_dict()))
+
+        if len(chunk) >= _EXPORT_CHUNK_SIZE:
+            yield b'\n'.join(chunk) + b'\n'
+            chunk.clear()
+
+    if chunk:
+        yield b'\n'.join(chunk) + b'\n'
@@ -0,0 +1,64 @@
+from collections.abc import Mapping, Sequence
+from enum import Enum
+
+from config import REVERT_GROUP_MAX_CHANGES
+
+
+class RevertGrouping(Enum):
+    NONE = 'none'  # one changeset per invocation
+    USER = 'user'  # consecutive changesets by the same user
+    SIZE = 'size'  # consecutive changesets within REVERT_GROUP_MAX_CHANGES
+
+
+def group_changesets(
+    changesets: Sequence[int],
+    info: Mapping[int, dict],
+    *,
+    grouping: RevertGrouping,
+    group_size: int,
+) -> list[tuple[int, ...]]:
+    """
+    Split the changesets into batches reverted by a single osm_revert invocation, keeping their order.
+
+    `info` maps changeset ids to {'u': user id, 'n': number of changes}. Changesets without info
+    are reverted alone. No batch has more than `group_size` changesets.
+    """
+    if grouping == RevertGrouping.NONE or group_size <= 1:
+        return [(changeset_id,) for changeset_id in changesets]
+
+    result = []
+    group = []
+    group_key = None
+    group_changes = 0
+
+    for changeset_id in changesets:
+        changeset_info = info.get(changeset_id)
+
+        if changeset_info is None:
+            key = None
+            changes = 0
+        elif grouping == RevertGrouping.USER:
+            key = changeset_info['u']
+            changes = 0
+        else:
+            key = True
+            changes = changeset_info['n']
+
+        if group and (
+            key is None
+            or key != group_key
+            or len(group) >= group_size
+            or group_changes + changes > REVERT_GROUP_MAX_CHANGES
+        ):
+            result.append(tuple(group))
+            group = []
+            group_changes = 0
+
+        group.append(changeset_id)
+        group_key = key
+        group_changes += changes
+
+    if group:
+        result.append(tuple(group))
+
+    return result
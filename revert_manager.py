@@ -1,13 +1,22 @@
 from collections.abc import Sequence
 
+from config import REVERT_GLOBAL_CONCURRENCY
+from revert_scheduler import FairScheduler
+from revert_store import revert_store
 from revert_task import RevertTask
 from revert_worker import revert_worker
+from tracing import detach_trace
 
 
 class RevertManager:
     def __init__(self, tg) -> None:
         self._tg = tg
         self._tasks: list[RevertTask] = []
+        self._scheduler = FairScheduler(REVERT_GLOBAL_CONCURRENCY)
+
+    @property
+    def scheduler(self) -> FairScheduler:
+        return self._scheduler
 
     def get_all(self, *, ascending: bool = True) -> Sequence[RevertTask]:
         if ascending:
@@ -23,16 +32,41 @@ class RevertManager:
         if task is None:
             return False
         task.aborted = True
+        revert_store.mark_dirty(task)
         return True
 
-    def delete_by_id(self, id_: str) -> bool:
+    async def delete_by_id(self, id_: str) -> bool:
         task = self.get_by_id(id_)
         if task is None or not task.finished:
             return False
         self._tasks.remove(task)
+        await revert_store.delete(task.id)
         return True
 
-    def submit(self, task: RevertTask) -> None:
+    async def submit(self, task: RevertTask) -> None:
         assert self.get_by_id(task.id) is None, f'Task with ID {task.id!r} already exists'
+        await revert_store.insert(task)
+        self._start(task)
+
+    async def resume(self) -> None:
+        """Load the stored tasks, and continue the unfinished ones."""
+        for task in await revert_store.load():
+            if task.finished:
+                self._tasks.append(task)
+            else:
+                print(f'[REVERT] Resuming task {task.id}')
+                self._start(task)
+
+    def _start(self, task: RevertTask) -> None:
         self._tasks.append(task)
-        self._tg.start_soon(revert_worker, task)
+        self._scheduler.register(task)
+        self._tg.start_soon(self._run, task)
+
+    async def _run(self, task: RevertTask) -> None:
+        # started from the request that submitted the task, which must not stay in its trace for hours
+        detach_trace()
+
+        try:
+            await revert_worker(task, self._scheduler)
+        finally:
+            self._scheduler.unregister(task)
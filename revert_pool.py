@@ -0,0 +1,243 @@
+"""
+Pool of long-lived osm_revert worker processes.
+
+Workers are forked from a forkserver that has already imported osm_revert and its dependencies.
+A worker runs one job at a time: it receives (env, kwargs) over its pipe, streams the printed lines back,
+and finally reports whether osm_revert.main raised. Workers are recycled after REVERT_POOL_MAX_JOBS jobs,
+and killed on timeout or cancellation, exactly like the former one-process-per-changeset model.
+
+Waiting on a worker does not occupy a thread: the pipe is a socket pair, watched by the event loop.
+The number of in-flight reverts is then not capped by the AnyIO thread limiter.
+"""
+
+import io
+import multiprocessing
+import os
+import socket
+import sys
+import traceback
+from collections.abc import Callable
+from multiprocessing.connection import Connection
+
+import anyio
+from anyio import to_thread
+
+from config import REVERT_POOL_MAX_JOBS, REVERT_POOL_SIZE, VERSION_DATE
+from metrics import Gauge
+
+# osm_revert reads its environment at import time: the constant variables are set before the forkserver
+# starts and preloads it, so that workers only re-import it for tasks with their own variables
+os.environ['OSM_REVERT_VERSION_DATE'] = VERSION_DATE
+os.environ['OSM_REVERT_VERSION_SUFFIX'] = 'thanos'
+
+_CONTEXT = multiprocessing.get_context('forkserver')
+_CONTEXT.set_forkserver_preload(['osm_revert'])
+
+_processes = Gauge('thanos_revert_processes', 'Live osm_revert worker processes.')
+_busy_processes = Gauge('thanos_revert_busy_processes', 'osm_revert worker processes running a job.')
+
+
+# at most 4 bytes per character, well below the socket buffer size
+_MAX_LINE_LENGTH = 8192
+
+
+class _LineWriter(io.TextIOBase):
+    """Sends each printed line over the connection, truncated to _MAX_LINE_LENGTH characters."""
+
+    def __init__(self, conn: Connection) -> None:
+        self._conn = conn
+        self._buffer = ''
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        *lines, self._buffer = (self._buffer + s).split('\n')
+
+        for line in lines:
+            self._send(line)
+
+        # the rest of a long line is cut anyway, the buffer only keeps enough to know it was too long
+        self._buffer = self._buffer[: _MAX_LINE_LENGTH + 1]
+
+        return len(s)
+
+    def flush(self) -> None:
+        if self._buffer:
+            self._send(self._buffer)
+            self._buffer = ''
+
+    def _send(self, line: str) -> None:
+        if len(line) > _MAX_LINE_LENGTH:
+            line = line[: _MAX_LINE_LENGTH - 1] + '…'
+
+        self._conn.send(('log', line))
+
+
+def _reset_osm_revert() -> None:
+    # osm_revert reads its environment at import time
+    for name in tuple(sys.modules):
+        if name == 'osm_revert' or name.startswith('osm_revert.'):
+            del sys.modules[name]
+
+
+def _worker_main(conn: Connection) -> None:
+    base_env = os.environ.copy()
+    # the preloaded module was imported with the base environment only
+    imported_env = {}
+
+    while True:
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+
+        if job is None:
+            return
+
+        env, kwargs = job
+
+        os.environ.clear()
+        os.environ.update(base_env)
+        os.environ.update(env)
+
+        if imported_env != env:
+            _reset_osm_revert()
+            imported_env = env
+
+        writer = _LineWriter(conn)
+        sys.stdout = writer
+        exitcode = 0
+
+        try:
+            import osm_revert
+
+            osm_revert.main(**kwargs)
+        except SystemExit as e:
+            # like the exit status of a script: None is success, and a message is printed as a failure
+            if e.code is None or isinstance(e.code, int):
+                exitcode = e.code or 0
+            else:
+                print(e.code, file=writer)
+                exitcode = 1
+        except BaseException:
+            traceback.print_exc(file=writer)
+            exitcode = 1
+        finally:
+            writer.flush()
+            sys.stdout = sys.__stdout__
+
+        conn.send(('exit', exitcode))
+
+
+class _Worker:
+    __slots__ = ('conn', 'jobs', 'process', 'sock')
+
+    def __init__(self) -> None:
+        # a duplex pipe is a unix socket pair
+        self.conn, child_conn = _CONTEXT.Pipe(duplex=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM, fileno=os.dup(self.conn.fileno()))
+        self.process = _CONTEXT.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    async def recv(self) -> tuple[str, object]:
+        while not self.conn.poll():
+            await anyio.wait_socket_readable(self.sock)
+
+        # messages are small (see _MAX_LINE_LENGTH) and sent at once,
+        # so the rest of a started message is already there
+        return self.conn.recv()
+
+    def close(self) -> None:
+        try:
+            self.conn.send(None)
+        except OSError:
+            self.process.kill()
+        finally:
+            self.sock.close()
+            self.conn.close()
+            _processes.dec()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.sock.close()
+        self.conn.close()
+        _processes.dec()
+
+
+class RevertPool:
+    __slots__ = ('_idle',)
+
+    def __init__(self) -> None:
+        self._idle: list[_Worker] = []
+
+    async def _acquire(self) -> _Worker:
+        if self._idle:
+            return self._idle.pop()
+
+        # the first start also launches the forkserver
+        worker = await to_thread.run_sync(_Worker)
+        # metric values are only written from the event loop
+        _processes.inc()
+        return worker
+
+    def _release(self, worker: _Worker) -> None:
+        worker.jobs += 1
+
+        if worker.jobs >= REVERT_POOL_MAX_JOBS or len(self._idle) >= REVERT_POOL_SIZE:
+            worker.close()
+        else:
+            self._idle.append(worker)
+
+    async def run(
+        self,
+        *,
+        env: dict[str, str],
+        kwargs: dict,
+        log: Callable[[str], None],
+    ) -> int | None:
+        """
+        Run osm_revert.main(**kwargs) in a worker, passing each printed line to `log`.
+
+        `env` is added to the base environment; osm_revert is only re-imported when it differs from the previous job.
+
+        Returns 0 on success, 1 if it raised, and None if the worker crashed.
+        If cancelled, for example by a timeout, the worker is killed.
+        """
+        worker = await self._acquire()
+        release = False
+        _busy_processes.inc()
+
+        try:
+            worker.conn.send((env, kwargs))
+
+            while True:
+                try:
+                    kind, value = await worker.recv()
+                except (EOFError, OSError):
+                    return None
+
+                if kind == 'log':
+                    log(value)
+                else:
+                    release = True
+                    return value
+
+        finally:
+            _busy_processes.dec()
+
+            if release:
+                self._release(worker)
+            else:
+                worker.kill()
+
+    def close(self) -> None:
+        for worker in self._idle:
+            worker.close()
+
+        self._idle.clear()
+
+
+revert_pool = RevertPool()
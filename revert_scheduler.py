@@ -0,0 +1,90 @@
+from collections.abc import AsyncGenerator
+from contextlib import asynccontextmanager
+
+import anyio
+
+from revert_task import RevertTask
+
+
+class FairScheduler:
+    """
+    Global budget of concurrent revert jobs, shared between tasks in proportion to their priority.
+
+    When a slot frees up, it goes to the waiting task with the fewest running jobs per unit of priority,
+    ties broken by submission order. A task waiting without any running job is marked as queued.
+    """
+
+    __slots__ = ('_active', '_budget', '_changed', '_order', '_tasks', '_waiters')
+
+    def __init__(self, budget: int) -> None:
+        self._budget = budget
+        self._order: dict[str, int] = {}
+        self._tasks: dict[str, RevertTask] = {}
+        self._active: dict[str, int] = {}
+        self._waiters: dict[str, int] = {}
+        self._changed: anyio.Event | None = None
+
+    @property
+    def budget(self) -> int:
+        return self._budget
+
+    @property
+    def active(self) -> int:
+        return sum(self._active.values())
+
+    def register(self, task: RevertTask) -> None:
+        self._order[task.id] = len(self._order)
+        self._tasks[task.id] = task
+        task.queued = True
+
+    def unregister(self, task: RevertTask) -> None:
+        self._order.pop(task.id, None)
+        self._tasks.pop(task.id, None)
+
+    def _is_next(self, task: RevertTask) -> bool:
+        if self.active >= self._budget:
+            return False
+
+        def share(task_id: str) -> tuple[float, int]:
+            return self._active.get(task_id, 0) / self._tasks[task_id].priority, self._order[task_id]
+
+        return min(self._waiters, key=share) == task.id
+
+    def _notify(self) -> None:
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    @asynccontextmanager
+    async def slot(self, task: RevertTask) -> AsyncGenerator[None, None]:
+        self._waiters[task.id] = self._waiters.get(task.id, 0) + 1
+        task.queued = not self._active.get(task.id)
+
+        try:
+            while not self._is_next(task):
+                if self._changed is None:
+                    self._changed = anyio.Event()
+                await self._changed.wait()
+        except BaseException:
+            # a cancelled waiter may have been next in line
+            self._notify()
+            raise
+        finally:
+            self._waiters[task.id] -= 1
+            if not self._waiters[task.id]:
+                del self._waiters[task.id]
+
+        self._active[task.id] = self._active.get(task.id, 0) + 1
+        task.queued = False
+
+        # another waiting task may be next in line
+        self._notify()
+
+        try:
+            yield
+        finally:
+            self._active[task.id] -= 1
+            if not self._active[task.id]:
+                del self._active[task.id]
+
+            self._notify()
@@ -0,0 +1,261 @@
+"""
+Durable record of the revert tasks, so that a restart resumes them instead of losing them.
+
+A task document holds everything needed to run the task again, and a status document per changeset
+tracks the current pass: pending, running, done or failed, with the outcome and the duration of the latest
+attempt. The worker only updates the in-memory task,
+and the changes are written in batches every REVERT_STORE_FLUSH_INTERVAL. Status updates are coalesced
+into one update_many per task, status and outcome, and durations into one update_many per task and duration,
+which is shared by the changesets of a grouped job. On restart, the changesets still pending or running are reverted
+again: a changeset interrupted in the middle of its revert is submitted once more.
+The hidden options, which hold the user's OAuth token, are removed once the task is finished or aborted.
+"""
+
+from collections import defaultdict
+from collections.abc import Iterable, Sequence
+from datetime import timedelta
+
+import anyio
+import pymongo
+from pymongo import UpdateMany, UpdateOne
+
+from config import REVERT_STORE_FLUSH_INTERVAL
+from config_db import REVERT_STATUS_COLLECTION, REVERT_TASK_COLLECTION
+from metrics import mongo_write_seconds
+from revert_grouping import RevertGrouping
+from revert_task import ChangesetOutcome, ChangesetStatus, RevertOutcome, RevertTask
+from task_log import TaskLog
+from utils import retry_exponential
+
+_INSERT_BATCH_SIZE = 10000
+
+
+def _progress_doc(task: RevertTask) -> dict:
+    return {
+        'current_pass': task.current_pass,
+        'progress': task.progress,
+        'aborted': task.aborted,
+        'finished': task.finished,
+    }
+
+
+def _progress_update(task: RevertTask) -> dict:
+    update = {'$set': _progress_doc(task)}
+
+    # the hidden options hold the user's OAuth token, which is not kept once the task cannot run anymore
+    if task.finished:
+        update['$unset'] = {'hidden_options': True}
+
+    return update
+
+
+def _task_doc(task: RevertTask) -> dict:
+    return {
+        '_id': task.id,
+        'changesets': list(task.changesets),
+        # groups are consecutive runs of the changesets, storing them again could exceed the document size limit
+        'group_sizes': [len(group) for group in task.groups],
+        'grouping': task.grouping.value,
+        'time_range': list(task.time_range),
+        'envs': task.envs,
+        'hidden_options': task.hidden_options,
+        'options': task.options,
+        'passes': task.passes,
+        'iterator_delay': task.iterator_delay.total_seconds(),
+        'parallel': task.parallel,
+        'priority': task.priority,
+        **_progress_doc(task),
+    }
+
+
+def _split_groups(changesets: Sequence[int], group_sizes: Sequence[int]) -> list[tuple[int, ...]]:
+    result = []
+    start = 0
+
+    for size in group_sizes:
+        result.append(tuple(changesets[start : start + size]))
+        start += size
+
+    return result
+
+
+def _status_set_doc(status: ChangesetStatus, outcome: RevertOutcome | None) -> dict:
+    if outcome is None:
+        return {'s': status.value}
+
+    return {'s': status.value, 'o': outcome.value}
+
+
+def _task_from_doc(
+    doc: dict,
+    statuses: dict[int, ChangesetStatus],
+    outcomes: dict[int, ChangesetOutcome],
+) -> RevertTask:
+    return RevertTask(
+        id=doc['_id'],
+        changesets=doc['changesets'],
+        # stored as a list of groups before group_sizes
+        groups=doc['groups'] if 'groups' in doc else _split_groups(doc['changesets'], doc['group_sizes']),
+        grouping=RevertGrouping(doc['grouping']),
+        time_range=tuple(doc['time_range']),
+        envs=doc['envs'],
+        hidden_options=doc.get('hidden_options', {}),
+        options=doc['options'],
+        passes=doc['passes'],
+        current_pass=doc['current_pass'],
+        statuses=statuses,
+        outcomes=outcomes,
+        progress=doc['progress'],
+        logs=TaskLog(),
+        iterator_delay=timedelta(seconds=doc['iterator_delay']),
+        parallel=doc['parallel'],
+        concurrency=0,
+        priority=doc['priority'],
+        queued=True,
+        aborted=doc['aborted'],
+        finished=doc['finished'],
+    )
+
+
+class RevertStore:
+    __slots__ = ('_statuses', '_tasks')
+
+    def __init__(self) -> None:
+        self._statuses: dict[tuple[str, int], tuple[ChangesetStatus, ChangesetOutcome | None]] = {}
+        self._tasks: dict[str, RevertTask] = {}
+
+    async def insert(self, task: RevertTask) -> None:
+        await REVERT_TASK_COLLECTION.insert_one(_task_doc(task))
+
+        for i in range(0, len(task.changesets), _INSERT_BATCH_SIZE):
+            await REVERT_STATUS_COLLECTION.insert_many(
+                [
+                    {'t': task.id, 'c': changeset_id, 's': task.statuses[changeset_id].value}
+                    for changeset_id in task.changesets[i : i + _INSERT_BATCH_SIZE]
+                ],
+                ordered=False,
+            )
+
+    async def delete(self, task_id: str) -> None:
+        self._tasks.pop(task_id, None)
+        self._statuses = {key: status for key, status in self._statuses.items() if key[0] != task_id}
+
+        await REVERT_STATUS_COLLECTION.delete_many({'t': task_id})
+        await REVERT_TASK_COLLECTION.delete_one({'_id': task_id})
+
+    async def load(self) -> list[RevertTask]:
+        """Return all stored tasks, oldest first."""
+        result = []
+
+        async for doc in REVERT_TASK_COLLECTION.find(sort=[('_id', pymongo.ASCENDING)]):
+            statuses = {}
+            outcomes = {}
+
+            async for status_doc in REVERT_STATUS_COLLECTION.find({'t': doc['_id']}, projection={'_id': False}):
+                changeset_id = status_doc['c']
+                statuses[changeset_id] = ChangesetStatus(status_doc['s'])
+
+                if 'o' in status_doc:
+                    outcomes[changeset_id] = ChangesetOutcome(
+                        outcome=RevertOutcome(status_doc['o']),
+                        duration=status_doc['d'],
+                    )
+
+            # tolerate a crash between the task and the status inserts
+            for changeset_id in doc['changesets']:
+                statuses.setdefault(changeset_id, ChangesetStatus.PENDING)
+
+            task = _task_from_doc(doc, statuses, outcomes)
+            result.append(task)
+
+            # stored before the hidden options were removed on finish
+            if task.finished and task.hidden_options:
+                task.hidden_options = {}
+                self.mark_dirty(task)
+
+        return result
+
+    def mark_dirty(self, task: RevertTask) -> None:
+        """Schedule writing the progress of the task."""
+        self._tasks[task.id] = task
+
+    def set_status(
+        self,
+        task: RevertTask,
+        changeset_ids: Iterable[int],
+        status: ChangesetStatus,
+        outcome: ChangesetOutcome | None = None,
+    ) -> None:
+        for changeset_id in changeset_ids:
+            task.statuses[changeset_id] = status
+            key = (task.id, changeset_id)
+
+            if outcome is not None:
+                task.set_outcome(changeset_id, outcome)
+                self._statuses[key] = (status, outcome)
+            else:
+                # keep an outcome that is not written yet
+                previous = self._statuses.get(key)
+                self._statuses[key] = (status, previous[1] if previous is not None else None)
+
+        self._tasks[task.id] = task
+
+    @retry_exponential(None)
+    async def flush(self) -> None:
+        if not self._statuses and not self._tasks:
+            return
+
+        statuses, self._statuses = self._statuses, {}
+        tasks, self._tasks = self._tasks, {}
+
+        try:
+            # the duration differs between jobs, it would split the status updates if it was grouped with them
+            grouped: defaultdict[tuple[str, ChangesetStatus, RevertOutcome | None], list[int]] = defaultdict(list)
+            durations: defaultdict[tuple[str, float], list[int]] = defaultdict(list)
+
+            for (task_id, changeset_id), (status, outcome) in statuses.items():
+                if outcome is None:
+                    grouped[task_id, status, None].append(changeset_id)
+                else:
+                    grouped[task_id, status, outcome.outcome].append(changeset_id)
+                    durations[task_id, outcome.duration].append(changeset_id)
+
+            with mongo_write_seconds.time(operation='revert_store_flush'):
+                # statuses first: a crash in between then repeats some work, instead of skipping it
+                if grouped:
+                    await REVERT_STATUS_COLLECTION.bulk_write(
+                        [
+                            *(
+                                UpdateMany(
+                                    {'t': task_id, 'c': {'$in': changeset_ids}},
+                                    {'$set': _status_set_doc(status, outcome)},
+                                )
+                                for (task_id, status, outcome), changeset_ids in grouped.items()
+                            ),
+                            *(
+                                UpdateMany({'t': task_id, 'c': {'$in': changeset_ids}}, {'$set': {'d': duration}})
+                                for (task_id, duration), changeset_ids in durations.items()
+                            ),
+                        ],
+                        ordered=False,
+                    )
+
+                if tasks:
+                    await REVERT_TASK_COLLECTION.bulk_write(
+                        [UpdateOne({'_id': task.id}, _progress_update(task)) for task in tasks.values()],
+                        ordered=False,
+                    )
+
+        except BaseException:
+            # keep the newer updates made in the meantime
+            self._statuses = statuses | self._statuses
+            self._tasks = tasks | self._tasks
+            raise
+
+    async def run(self) -> None:
+        while True:
+            await anyio.sleep(REVERT_STORE_FLUSH_INTERVAL.total_seconds())
+            await self.flush()
+
+
+revert_store = RevertStore()
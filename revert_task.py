@@ -1,22 +1,84 @@
 from collections.abc import Sequence
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from datetime import datetime, timedelta
-from queue import Queue
+from enum import Enum
 from typing import Any
 
+from revert_grouping import RevertGrouping
+from task_log import TaskLog
+
+
+class ChangesetStatus(Enum):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class RevertOutcome(Enum):
+    SUCCESS = 'success'
+    NOOP = 'noop'
+    CONFLICT = 'conflict'
+    FAILED = 'failed'
+
+    @property
+    def succeeded(self) -> bool:
+        # follow-up passes retry the rest
+        return self in (RevertOutcome.SUCCESS, RevertOutcome.NOOP)
+
+
+@dataclass(frozen=True, kw_only=True, slots=True)
+class ChangesetOutcome:
+    outcome: RevertOutcome
+    duration: float  # seconds, an even share of the job for grouped reverts
+
 
 @dataclass(kw_only=True, slots=True)
 class RevertTask:
     id: str
     changesets: Sequence[int]
+    groups: Sequence[Sequence[int]]
+    grouping: RevertGrouping
     time_range: tuple[datetime, datetime]
     envs: dict[str, str]
     hidden_options: dict[str, Any]
     options: dict[str, Any]
     passes: int
+    current_pass: int
+    statuses: dict[int, ChangesetStatus]  # of the current pass, persisted by revert_store
+    outcomes: dict[int, ChangesetOutcome]  # of the latest attempt, persisted by revert_store
     progress: float
-    logs: Queue[str]
+    logs: TaskLog
     iterator_delay: timedelta
     parallel: bool
+    concurrency: int  # effective number of concurrent reverts
+    priority: int  # weight in the fair share of REVERT_GLOBAL_CONCURRENCY
+    queued: bool  # waiting for the scheduler, without any running revert
     aborted: bool
     finished: bool
+
+    # running totals of `outcomes`, read on every update of the revert page
+    outcome_counts: dict[RevertOutcome, int] = field(init=False)
+    outcomes_duration: float = field(init=False)
+
+    def __post_init__(self) -> None:
+        self.outcome_counts = dict.fromkeys(RevertOutcome, 0)
+        self.outcomes_duration = 0
+
+        for outcome in self.outcomes.values():
+            self.outcome_counts[outcome.outcome] += 1
+            self.outcomes_duration += outcome.duration
+
+    def set_outcome(self, changeset_id: int, outcome: ChangesetOutcome) -> None:
+        previous = self.outcomes.get(changeset_id)
+
+        if previous is not None:
+            self.outcome_counts[previous.outcome] -= 1
+            self.outcomes_duration -= previous.duration
+
+        self.outcomes[changeset_id] = outcome
+        self.outcome_counts[outcome.outcome] += 1
+        self.outcomes_duration += outcome.duration
+
+    def outcome_totals(self) -> dict[RevertOutcome, int]:
+        return self.outcome_counts.copy()
@@ -1,144 +1,251 @@
-import io
-import os
-import sys
+import re
+import time
 import traceback
+from collections.abc import Sequence
 from datetime import timedelta
-from multiprocessing import Pipe, Process
-from multiprocessing.connection import Connection
-from queue import Full
 
 import anyio
-from anyio import get_cancelled_exc_class, open_file, to_thread
 
-from config import CHANGESET_CONCURRENCY, VERSION_DATE
-from revert_task import RevertTask
+from config import CHANGESET_CONCURRENCY, REVERT_TIMEOUT, REVERT_TIMEOUT_PER_CHANGESET
+from metrics import Counter, Histogram
+from revert_concurrency import ConcurrencyController
+from revert_pool import revert_pool
+from revert_scheduler import FairScheduler
+from revert_store import revert_store
+from revert_task import ChangesetOutcome, ChangesetStatus, RevertOutcome, RevertTask
+from task_log import EventLevel, EventType
 from utils import retry_exponential
 
+# osm_revert status lines of a successful run that changed nothing, or had to skip conflicting elements,
+# anchored so that changeset comments or tags echoed in the output do not match
+_NOOP_RE = re.compile(r'^\W*nothing to revert\b', re.IGNORECASE)
+_CONFLICT_RE = re.compile(r'^\W*(?:\d+ )?conflicts?\b', re.IGNORECASE)
 
-async def revert_worker(task: RevertTask) -> None:
-    def log(text: str) -> None:
-        try:
-            task.logs.put_nowait(text)
-        except Full:
-            try:
-                task.logs.get_nowait()
-            finally:
-                log(text)
+_job_seconds = Histogram('thanos_revert_job_seconds', 'Duration of osm_revert jobs, by exit.', ('exit',))
+_reverted_changesets = Counter(
+    'thanos_reverted_changesets_total',
+    'Changesets processed by revert tasks, by outcome.',
+    ('task', 'outcome'),
+)
+
+
+def _job_timeout(group: Sequence[int]) -> float:
+    # a flat timeout would be hit by every large group, and paid again at every level of splitting
+    return (REVERT_TIMEOUT + REVERT_TIMEOUT_PER_CHANGESET * (len(group) - 1)).total_seconds()
+
+
+def _unprocessed_groups(task: RevertTask) -> list[Sequence[int]]:
+    # running changesets were interrupted by a restart
+    unprocessed = (ChangesetStatus.PENDING, ChangesetStatus.RUNNING)
+    result = []
+
+    for group in task.groups:
+        group = tuple(changeset_id for changeset_id in group if task.statuses[changeset_id] in unprocessed)
+
+        if group:
+            result.append(group)
+
+    return result
+
+
+async def revert_worker(task: RevertTask, scheduler: FairScheduler) -> None:
+    log = task.logs.add
 
     num_workers = CHANGESET_CONCURRENCY if task.parallel else 1
+    controller = ConcurrencyController(num_workers)
+    task.concurrency = controller.limit
     iterator_delay_seconds = task.iterator_delay.total_seconds()
-    send_stream, recv_stream = anyio.create_memory_object_stream(max_buffer_size=0)
-
-    async def changeset_worker() -> None:
-        async for changeset_id in recv_stream:
-            changeset_id: int
-
-            @retry_exponential(timedelta(hours=2), start=timedelta(seconds=15))
-            async def inner(changeset_id: int) -> None:
-                if task.aborted:
-                    return
-
-                log(f'[INFO] ⚙️ Reverting {changeset_id}...')
-
-                r, w = Pipe(duplex=False)
-                exitcode = None
-
-                with anyio.fail_after(300), r, w:  # 5 minutes
-                    async with anyio.create_task_group() as tg:
-
-                        async def process_task():
-                            nonlocal exitcode
-
-                            proc = Process(
-                                target=revert_worker_process,
-                                kwargs={
-                                    'conn': w,
-                                    'env': {
-                                        **task.envs,
-                                        'OSM_REVERT_VERSION_DATE': VERSION_DATE,
-                                        'OSM_REVERT_VERSION_SUFFIX': 'thanos',
-                                    },
-                                    'changeset_ids': [changeset_id],
-                                    **task.hidden_options,
-                                    **task.options,
-                                },
-                            )
-
-                            proc.start()
-
-                            try:
-                                await to_thread.run_sync(proc.join, cancellable=True)
-                            except get_cancelled_exc_class():
-                                proc.kill()
-                                raise
-
-                            w.send_bytes(b'EOF\n')
-                            exitcode = proc.exitcode
-
-                        tg.start_soon(process_task)
-
-                        async with await open_file(r.fileno(), closefd=False) as stdout:
-                            async for line in stdout:
-                                if line.endswith('EOF\n'):
-                                    break
-                                line = line.rstrip(' \n')
-                                if num_workers > 1:
-                                    line = f'({changeset_id}) {line}'
-                                log(line)
-
-                if exitcode is None or exitcode != 0:
-                    log(f'[INFO] 🔁 Reverting {changeset_id} failed, retrying...')
-                    raise RuntimeError(f'Reverting {changeset_id} failed: {exitcode}')
+
+    async def revert(group: Sequence[int]) -> tuple[int | None, bool]:
+        """Return the exit code, and whether a grouped job had conflicts: its outcome is then not recorded."""
+        target = {'changeset_id': group[0], 'last_changeset_id': group[-1], 'count': len(group)}
+        congested = False
+        noop = False
+        conflict = False
+        exitcode = None
+
+        def log_line(line: str) -> None:
+            nonlocal congested, noop, conflict
+            line = line.rstrip(' \n')
+            congested = congested or controller.is_congestion(line)
+            noop = noop or _NOOP_RE.search(line) is not None
+            conflict = conflict or _CONFLICT_RE.search(line) is not None
+            log(EventType.OUTPUT, line, **target)
+
+        await controller.acquire()
+        revert_store.set_status(task, group, ChangesetStatus.RUNNING)
+        ts = time.perf_counter()
+
+        try:
+            async with scheduler.slot(task):
+                log(EventType.REVERT_STARTED, **target)
+                ts = time.perf_counter()
+
+                with anyio.fail_after(_job_timeout(group)):
+                    exitcode = await revert_pool.run(
+                        env=task.envs,
+                        kwargs={
+                            'changeset_ids': list(group),
+                            **task.hidden_options,
+                            **task.options,
+                        },
+                        log=log_line,
+                    )
+
+                if exitcode == 0:
+                    # the output does not tell which changesets of the group conflicted
+                    if conflict and len(group) > 1:
+                        return exitcode, True
+
+                    if conflict:
+                        outcome = RevertOutcome.CONFLICT
+                    elif noop:
+                        outcome = RevertOutcome.NOOP
+                    else:
+                        outcome = RevertOutcome.SUCCESS
+
+                    duration = time.perf_counter() - ts
+                    log(EventType.REVERT_FINISHED, outcome.value, duration=duration, **target)
+                    _reverted_changesets.inc(len(group), task=task.id, outcome=outcome.value)
+                    revert_store.set_status(
+                        task,
+                        group,
+                        ChangesetStatus.DONE,
+                        ChangesetOutcome(outcome=outcome, duration=duration / len(group)),
+                    )
+
+                return exitcode, False
+        finally:
+            duration = time.perf_counter() - ts
+            _job_seconds.observe(duration, exit='ok' if exitcode == 0 else 'error' if exitcode else 'killed')
+            # per changeset, to compare single changesets with whole groups
+            controller.release(success=exitcode == 0, duration=duration / len(group), congested=congested)
+            task.concurrency = controller.limit
+
+    @retry_exponential(timedelta(hours=2), start=timedelta(seconds=15))
+    async def revert_single(changeset_id: int) -> None:
+        if task.aborted:
+            return
+
+        exitcode, _ = await revert((changeset_id,))
+
+        if exitcode is None or exitcode != 0:
+            log(EventType.REVERT_RETRY, level=EventLevel.WARNING, changeset_id=changeset_id)
+            raise RuntimeError(f'Reverting {changeset_id} failed: {exitcode}')
+
+    async def revert_group(group: Sequence[int]) -> None:
+        if task.aborted:
+            return
+
+        if len(group) == 1:
+            ts = time.perf_counter()
 
             try:
-                await inner(changeset_id)
+                await revert_single(group[0])
             except Exception:
                 # revert exceptions are non-critical but should be avoided
-                log(f'[INFO] ❌ Reverting {changeset_id} failed')
+                duration = time.perf_counter() - ts
+                log(EventType.REVERT_FAILED, level=EventLevel.ERROR, changeset_id=group[0], duration=duration)
+                _reverted_changesets.inc(task=task.id, outcome=RevertOutcome.FAILED.value)
+                revert_store.set_status(
+                    task,
+                    group,
+                    ChangesetStatus.FAILED,
+                    ChangesetOutcome(outcome=RevertOutcome.FAILED, duration=duration),
+                )
                 traceback.print_exc()
+            return
+
+        try:
+            exitcode, conflict = await revert(group)
+        except Exception:
+            traceback.print_exc()
+            exitcode, conflict = None, False
+
+        if conflict:
+            # the clean changesets come out as nothing to revert, and only the conflicting ones are retried
+            log(
+                EventType.GROUP_CONFLICT,
+                level=EventLevel.WARNING,
+                changeset_id=group[0],
+                last_changeset_id=group[-1],
+                count=len(group),
+            )
+
+            for changeset_id in group:
+                await revert_group((changeset_id,))
+
+        elif exitcode is None or exitcode != 0:
+            # narrow down the failing changesets, the rest is reverted in fewer invocations
+            log(
+                EventType.GROUP_SPLIT,
+                level=EventLevel.WARNING,
+                changeset_id=group[0],
+                last_changeset_id=group[-1],
+                count=len(group),
+            )
+            mid = len(group) // 2
+            await revert_group(group[:mid])
+            await revert_group(group[mid:])
+
+    async def changeset_worker(recv_stream) -> None:
+        async for group in recv_stream:
+            group: Sequence[int]
+            await revert_group(group)
 
             if iterator_delay_seconds > 0:
-                log(f'[INFO] 🕒 Delaying {iterator_delay_seconds} seconds...')
+                log(EventType.DELAY, duration=iterator_delay_seconds)
                 await anyio.sleep(iterator_delay_seconds)
 
-    total_reverts = len(task.changesets) * task.passes
-    reverts = 0
+    def finish() -> None:
+        task.finished = True
+        task.hidden_options = {}
+        revert_store.mark_dirty(task)
+
+    num_changesets = len(task.changesets)
+    total_reverts = num_changesets * task.passes
+
+    for pass_ in range(task.current_pass, task.passes + 1):
+        if pass_ != task.current_pass:
+            task.current_pass = pass_
+            retries = [
+                changeset_id
+                for changeset_id in task.changesets
+                if (outcome := task.outcomes.get(changeset_id)) is None or not outcome.outcome.succeeded
+            ]
+
+            if not retries:
+                log(EventType.PASS_SKIPPED, f'{pass_} of {task.passes}')
+                break
+
+            # only the changesets that did not succeed are scheduled again
+            revert_store.set_status(task, retries, ChangesetStatus.PENDING)
+
+        groups = _unprocessed_groups(task)
+        reverts = (pass_ - 1) * num_changesets + num_changesets - sum(map(len, groups))
 
-    for pass_ in range(1, task.passes + 1):
-        log(f'[INFO] 🔁 Starting pass {pass_} of {task.passes}')
+        # fewer after a restart, or in follow-up passes
+        log(EventType.PASS_STARTED, f'{pass_} of {task.passes}', count=sum(map(len, groups)))
+
+        send_stream, recv_stream = anyio.create_memory_object_stream(max_buffer_size=0)
 
         async with anyio.create_task_group() as tg:
             for _ in range(num_workers):
-                tg.start_soon(changeset_worker)
+                tg.start_soon(changeset_worker, recv_stream)
 
             async with send_stream:
-                for changeset_id in task.changesets:
+                for group in groups:
                     if task.aborted:
-                        log('[INFO] 🛑 Task aborted')
-                        task.finished = True
+                        log(EventType.TASK_ABORTED)
+                        finish()
                         return
 
-                    await send_stream.send(changeset_id)
-                    reverts += 1
+                    await send_stream.send(group)
+                    reverts += len(group)
                     task.progress = reverts / total_reverts
+                    revert_store.mark_dirty(task)
 
-    assert reverts == total_reverts, f'{reverts} != {total_reverts}'
-    log('[INFO] 🏁 Revert task finished')
-    task.finished = True
-
-
-def revert_worker_process(
-    *,
-    conn: Connection,
-    env: dict[str, str],
-    **kwargs,
-) -> int:
-    # Redirect stdout to the pipe
-    sys.stdout = io.TextIOWrapper(os.fdopen(conn.fileno(), 'wb', buffering=0), write_through=True)
-
-    for k, v in env.items():
-        os.environ[k] = v
-
-    import osm_revert
-
-    return osm_revert.main(**kwargs)
+    totals = ', '.join(f'{count} {outcome.value}' for outcome, count in task.outcome_totals().items() if count)
+    log(EventType.TASK_FINISHED, totals)
+    task.progress = 1
+    finish()
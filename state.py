@@ -7,3 +7,7 @@ async def get_state_doc(name: str, **kwargs) -> dict | None:
 
 async def set_state_doc(name: str, doc: dict, **kwargs) -> None:
     await STATE_COLLECTION.replace_one({'_name': name}, doc | {'_name': name}, upsert=True, **kwargs)
+
+
+async def update_state_doc(name: str, update: dict, **kwargs) -> None:
+    await STATE_COLLECTION.update_one({'_name': name}, update, upsert=True, **kwargs)
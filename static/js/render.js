@@ -48,24 +48,18 @@ const escapeHTML = str => {
     return div.innerHTML
 }
 
-export const renderChangesets = changesets => {
-    ['legitimate', 'uncategorized', 'malicious'].forEach(category => {
-        clusterize[category] = initClusterize(category)
-    })
+const renderChangeset = cs => {
+    const escapedUser = escapeHTML(cs['@user'])
+    const escapedComment = escapeHTML(cs.tags.comment || '(no comment)')
+    let userPrefix = ''
 
-    const ids = Object.keys(changesets).map(id => parseInt(id))
-    const rows = Object.values(changesets).map(cs => {
-        const escapedUser = escapeHTML(cs['@user'])
-        const escapedComment = escapeHTML(cs.tags.comment || '(no comment)')
-        let userPrefix = ''
+    if (cs._deleted)
+        userPrefix += '<span title="Deleted account">☠️</span>'
 
-        if (cs._deleted)
-            userPrefix += '<span title="Deleted account">☠️</span>'
+    if (cs._blocked)
+        userPrefix += '<span title="Blocked user">🚫</span>'
 
-        if (cs._blocked)
-            userPrefix += '<span title="Blocked user">🚫</span>'
-
-        return `
+    return `
         <div class="changeset-item py-1" data-id="${cs['@id']}" draggable="true">
             <div class="card">
                 <div class="card-body">
@@ -97,9 +91,66 @@ export const renderChangesets = changesets => {
                 </div>
             </div>
         </div>
-    `})
+    `
+}
+
+export const initializeChangesets = () => {
+    ['legitimate', 'uncategorized', 'malicious'].forEach(category => {
+        clusterize[category] = initClusterize(category)
+    })
+}
+
+export const appendChangesets = changesets => {
+    const target = clusterize.uncategorized
+    target.ids.push(...changesets.map(cs => cs['@id']))
+    target.rows.push(...changesets.map(renderChangeset))
+    target.customUpdate(target.ids, target.rows)
+}
+
+const renderSummaryRows = (element, rows) => {
+    element.innerHTML = rows.map(([label, title, changesets, numChanges]) => `
+        <tr>
+            <td title="${escapeHTML(title)}">${label}</td>
+            <td title="Changesets">${changesets}</td>
+            <td title="Changes">${numChanges}</td>
+        </tr>
+    `).join('')
+}
+
+export const renderSummary = summary => {
+    const container = document.getElementById('summary')
+
+    container.querySelector('.summary-totals').textContent = summary.changesets ?
+        `${summary.changesets} changesets with ${summary.num_changes} changes by ${summary.users} users, ` +
+        `closed between ${summary.first_closed_at} and ${summary.last_closed_at}` :
+        'No changesets found'
+
+    const maxBin = Math.max(1, ...summary.histogram.map(bin => bin.changesets))
+    container.querySelector('.summary-histogram').innerHTML = summary.histogram.map(bin => `
+        <div style="height: ${bin.changesets / maxBin * 100}%"
+            title="${bin.start} (${summary.histogram_unit}): ${bin.changesets} changesets, ${bin.num_changes} changes"></div>
+    `).join('')
+
+    renderSummaryRows(container.querySelector('.summary-top-users'), summary.top_users.map(user => {
+        const name = user.display_name ?? `user_${user.uid}`
+        let prefix = ''
+
+        if (user.display_name === null)
+            prefix += '<span title="Deleted account">☠️</span>'
+
+        if (user.blocked)
+            prefix += '<span title="Blocked user">🚫</span>'
+
+        const link = `<a href="https://www.openstreetmap.org/user/${encodeURIComponent(name)}" target="_blank">${escapeHTML(name)}</a>`
+        return [prefix + link, name, user.changesets, user.num_changes]
+    }))
 
-    clusterize.uncategorized.customUpdate(ids, rows)
+    for (const [selector, values] of [
+        ['.summary-top-created-by', summary.top_created_by],
+        ['.summary-top-comments', summary.top_comments],
+    ])
+        renderSummaryRows(container.querySelector(selector), values.map(v =>
+            [escapeHTML(v.value), v.value, v.changesets, v.num_changes]))
 }
 
 const configureForm = document.getElementById('configure-form')
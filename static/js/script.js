@@ -1,28 +1,149 @@
-import { renderChangesets } from './render.js'
+import { appendChangesets, initializeChangesets, renderSummary } from './render.js'
 
 for (const e of document.querySelectorAll('.tagify')) {
     new Tagify(e)
 }
 
-if (window.changesets) {
-    for (const cs of Object.values(window.changesets)) {
-        if (cs.user)
-            cs['@user'] = cs.user.display_name
-        else
-            cs['@user'] = `user_${cs['@uid']}`
+const prepareChangeset = cs => {
+    if (cs.user)
+        cs['@user'] = cs.user.display_name
+    else
+        cs['@user'] = `user_${cs['@uid']}`
 
-        if (!cs.tags)
-            cs.tags = { 'comment': '(no comment)' }
-        else if (!cs.tags.comment)
-            cs.tags.comment = '(no comment)'
+    if (!cs.tags)
+        cs.tags = { 'comment': '(no comment)' }
+    else if (!cs.tags.comment)
+        cs.tags.comment = '(no comment)'
 
-        cs['_deleted'] = !cs.user
-        cs['_blocked'] = cs.user && cs['user']['blocks']['received']['active']
+    cs['_deleted'] = !cs.user
+    cs['_blocked'] = cs.user && cs['user']['blocks']['received']['active']
+}
+
+// yields arrays of changesets as they arrive in the NDJSON response
+async function* readChangesets(response) {
+    const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+    let buffer = ''
+
+    while (true) {
+        const { value, done } = await reader.read()
+        if (done) break
+
+        const lines = (buffer + value).split('\n')
+        buffer = lines.pop()
+        yield lines.filter(line => line).map(line => JSON.parse(line))
+    }
+
+    if (buffer)
+        yield [JSON.parse(buffer)]
+}
+
+const loadChangesets = async query => {
+    const status = document.getElementById('loading-status')
+    const submit = document.querySelector('#configure-form [type="submit"]')
+    let after = 0
+    let total = 0
+
+    window.changesets = {}
+    initializeChangesets()
+
+    while (true) {
+        const params = new URLSearchParams({ from_: query.from_, to: query.to, after: after, limit: query.limit })
+        for (const tag of query.tags)
+            params.append('tags', tag)
+
+        const response = await fetch(`/api/changesets?${params}`)
+        if (!response.ok)
+            throw new Error(`Failed to load changesets: ${response.status}`)
+
+        let pageCount = 0
+
+        for await (const changesets of readChangesets(response)) {
+            for (const cs of changesets) {
+                prepareChangeset(cs)
+                window.changesets[cs['@id']] = cs
+                after = cs['@id']
+            }
+
+            pageCount += changesets.length
+            total += changesets.length
+            appendChangesets(changesets)
+            status.textContent = `⏳ Loading changesets… (${total})`
+        }
+
+        // a partial page is the last one
+        if (pageCount < query.limit)
+            break
     }
 
-    renderChangesets(window.changesets)
+    status.textContent = `✅ Loaded ${total} changesets`
+    submit.disabled = false
+}
+
+const loadSummary = async query => {
+    const params = new URLSearchParams({ from_: query.from_, to: query.to })
+    for (const tag of query.tags)
+        params.append('tags', tag)
+
+    const response = await fetch(`/api/changesets/summary?${params}`)
+    if (!response.ok)
+        throw new Error(`Failed to summarize changesets: ${response.status}`)
+
+    renderSummary(await response.json())
+}
+
+if (window.changesetsQuery) {
+    loadSummary(window.changesetsQuery).catch(error => {
+        console.error(error)
+        document.querySelector('#summary .summary-totals').textContent = '❌ Failed to summarize changesets'
+    })
+
+    loadChangesets(window.changesetsQuery).catch(error => {
+        console.error(error)
+        document.getElementById('loading-status').textContent = '❌ Failed to load changesets, please try again'
+    })
+}
+
+const followRevertTask = task => {
+    const logs = document.getElementById('task-logs')
+    const progress = document.getElementById('task-progress')
+    const source = new EventSource(`/revert/${encodeURIComponent(task.id)}/events?after=${task.after}`)
+
+    source.addEventListener('log', event => {
+        const { lines, reset } = JSON.parse(event.data)
+        const atEnd = logs.scrollTop + logs.clientHeight >= logs.scrollHeight - 1
+
+        // the task was resumed after a restart, with a new log
+        if (reset)
+            logs.value = ''
+
+        logs.value += lines.map(line => line + '\n').join('')
+        if (atEnd)
+            logs.scrollTop = logs.scrollHeight
+    })
+
+    source.addEventListener('state', event => {
+        const state = JSON.parse(event.data)
+        const percent = `${Math.floor(state.progress * 100)}%`
+
+        progress.style.width = percent
+        progress.textContent = percent
+
+        for (const e of document.querySelectorAll('[data-state]'))
+            e.textContent = state[e.dataset.state]
+        for (const e of document.querySelectorAll('[data-outcome]'))
+            e.textContent = state.outcomes[e.dataset.outcome]
+
+        // the page renders the cleanup or aborting button
+        if (state.finished || (state.aborted && !document.querySelector('.card-footer [disabled]'))) {
+            source.close()
+            location.reload()
+        }
+    })
 }
 
+if (window.revertTask)
+    followRevertTask(window.revertTask)
+
 for (const e of document.querySelectorAll('.scroll-end')) {
     e.scrollTop = e.scrollHeight
 }
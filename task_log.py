@@ -0,0 +1,261 @@
+"""
+Structured log of a revert task.
+
+Every event has a timestamp, a level, a type, the changesets it is about (the first and last of a grouped
+revert), numeric payloads and a message. The events are stored column-wise in arrays, and the messages
+in a single UTF-8 blob, so that long tasks stay compact. Most events have no message at all: their text
+is rendered from the type and the payloads, only when it is read. Events are numbered from 1 by their
+sequence number. Past TASK_LOG_MAX_EVENTS, the oldest events are dropped in chunks, keeping the numbers.
+"""
+
+import math
+import time
+from array import array
+from collections.abc import Iterator
+from dataclasses import dataclass
+from enum import IntEnum
+
+import anyio
+
+from config import LOGS_TAIL_SIZE, TASK_LOG_MAX_EVENTS
+
+# dropped at once when the log is full, so that the arrays are not shifted on every event
+_TRIM_SIZE = max(TASK_LOG_MAX_EVENTS // 10, 1)
+
+
+class EventLevel(IntEnum):
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+
+class EventType(IntEnum):
+    OUTPUT = 0  # a line printed by osm_revert
+    PASS_STARTED = 1
+    PASS_SKIPPED = 2
+    REVERT_STARTED = 3
+    REVERT_FINISHED = 4
+    REVERT_RETRY = 5
+    REVERT_FAILED = 6
+    GROUP_SPLIT = 7
+    DELAY = 8
+    TASK_ABORTED = 9
+    TASK_FINISHED = 10
+    GROUP_CONFLICT = 11
+
+
+@dataclass(kw_only=True, slots=True)
+class Event:
+    seq: int
+    time: float
+    level: EventLevel
+    type: EventType
+    changeset_id: int  # 0 if none, the first changeset for grouped reverts
+    last_changeset_id: int  # the last changeset for grouped reverts, else changeset_id
+    count: int  # changesets in the job, or changesets in the pass
+    duration: float  # seconds, NaN if none
+    message: str
+
+    def to_dict(self) -> dict:
+        return {
+            'seq': self.seq,
+            'time': self.time,
+            'level': self.level.name,
+            'type': self.type.name,
+            'changeset_id': self.changeset_id or None,
+            'last_changeset_id': self.last_changeset_id or None,
+            'count': self.count,
+            'duration': None if math.isnan(self.duration) else self.duration,
+            'message': self.message,
+        }
+
+
+def _format_target(event: Event) -> str:
+    if event.count > 1:
+        return f'{event.count} changesets from {event.changeset_id}'
+
+    return str(event.changeset_id)
+
+
+def format_event(event: Event) -> str:
+    """Render the event as a log line."""
+    match event.type:
+        case EventType.OUTPUT:
+            return f'({_format_target(event)}) {event.message}' if event.changeset_id else event.message
+        case EventType.PASS_STARTED:
+            text = f'🔁 Starting pass {event.message} with {event.count} changesets'
+        case EventType.PASS_SKIPPED:
+            text = f'✅ All changesets succeeded, skipping pass {event.message}'
+        case EventType.REVERT_STARTED:
+            text = f'⚙️ Reverting {_format_target(event)}...'
+        case EventType.REVERT_FINISHED:
+            text = f'☑️ Reverted {_format_target(event)} in {event.duration:.1f}s: {event.message}'
+        case EventType.REVERT_RETRY:
+            text = f'🔁 Reverting {_format_target(event)} failed, retrying...'
+        case EventType.REVERT_FAILED:
+            text = f'❌ Reverting {_format_target(event)} failed'
+        case EventType.GROUP_SPLIT:
+            text = f'✂️ Reverting {_format_target(event)} failed, splitting...'
+        case EventType.GROUP_CONFLICT:
+            text = f'⚠️ Reverting {_format_target(event)} had conflicts, reverting them one by one...'
+        case EventType.DELAY:
+            text = f'🕒 Delaying {event.duration:g} seconds...'
+        case EventType.TASK_ABORTED:
+            text = '🛑 Task aborted'
+        case EventType.TASK_FINISHED:
+            text = f'🏁 Revert task finished: {event.message}'
+
+    return f'[{event.level.name}] {text}'
+
+
+class TaskLog:
+    __slots__ = (
+        '_changed',
+        '_changeset_ids',
+        '_counts',
+        '_dropped',
+        '_durations',
+        '_last_changeset_ids',
+        '_levels',
+        '_message_base',
+        '_message_ends',
+        '_messages',
+        '_times',
+        '_types',
+    )
+
+    def __init__(self) -> None:
+        self._times = array('d')
+        self._levels = array('B')
+        self._types = array('B')
+        self._changeset_ids = array('q')
+        self._last_changeset_ids = array('q')
+        self._counts = array('q')
+        self._durations = array('d')
+        self._message_ends = array('Q')  # offsets in all messages ever added
+        self._messages = bytearray()
+        self._message_base = 0  # length of the dropped messages
+        self._dropped = 0
+        self._changed: anyio.Event | None = None
+
+    def __len__(self) -> int:
+        return len(self._times)
+
+    @property
+    def first_seq(self) -> int:
+        return self._dropped + 1
+
+    @property
+    def last_seq(self) -> int:
+        return self._dropped + len(self._times)
+
+    def add(
+        self,
+        type_: EventType,
+        message: str = '',
+        *,
+        level: EventLevel = EventLevel.INFO,
+        changeset_id: int = 0,
+        last_changeset_id: int = 0,
+        count: int = 1,
+        duration: float = math.nan,
+    ) -> None:
+        self._times.append(time.time())
+        self._levels.append(level)
+        self._types.append(type_)
+        self._changeset_ids.append(changeset_id)
+        self._last_changeset_ids.append(last_changeset_id or changeset_id)
+        self._counts.append(count)
+        self._durations.append(duration)
+        self._messages += message.encode()
+        self._message_ends.append(self._message_base + len(self._messages))
+
+        if len(self._times) > TASK_LOG_MAX_EVENTS:
+            self._trim(_TRIM_SIZE)
+
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def _trim(self, count: int) -> None:
+        message_end = self._message_ends[count - 1] - self._message_base
+
+        for column in (
+            self._times,
+            self._levels,
+            self._types,
+            self._changeset_ids,
+            self._last_changeset_ids,
+            self._counts,
+            self._durations,
+            self._message_ends,
+        ):
+            del column[:count]
+
+        del self._messages[:message_end]
+        self._message_base += message_end
+        self._dropped += count
+
+    def get(self, seq: int) -> Event:
+        """Return a retained event, from `first_seq` to `last_seq`."""
+        i = seq - 1 - self._dropped
+        start = self._message_ends[i - 1] - self._message_base if i else 0
+
+        return Event(
+            seq=seq,
+            time=self._times[i],
+            level=EventLevel(self._levels[i]),
+            type=EventType(self._types[i]),
+            changeset_id=self._changeset_ids[i],
+            last_changeset_id=self._last_changeset_ids[i],
+            count=self._counts[i],
+            duration=self._durations[i],
+            message=self._messages[start : self._message_ends[i] - self._message_base].decode(),
+        )
+
+    def select(
+        self,
+        *,
+        after: int = 0,
+        changeset_id: int | None = None,
+        min_level: EventLevel = EventLevel.DEBUG,
+    ) -> Iterator[int]:
+        """
+        Yield the sequence numbers of the matching events after `after`, without decoding any event.
+
+        Consume the result before adding events: a trim would shift the events under it.
+        """
+        levels = self._levels
+        dropped = self._dropped
+        start = max(after - dropped, 0)
+
+        if changeset_id is None:
+            for i in range(start, len(levels)):
+                if levels[i] >= min_level:
+                    yield dropped + i + 1
+            return
+
+        # grouped reverts are sorted, in either order: match the changesets between their first and last one
+        first_ids = self._changeset_ids
+        last_ids = self._last_changeset_ids
+
+        for i in range(start, len(levels)):
+            first_id = first_ids[i]
+            last_id = last_ids[i]
+
+            if (first_id <= changeset_id <= last_id or last_id <= changeset_id <= first_id) and levels[i] >= min_level:
+                yield dropped + i + 1
+
+    def lines(self, *, after: int = 0, limit: int = LOGS_TAIL_SIZE) -> list[str]:
+        """Render the last `limit` events after `after`."""
+        last_seq = self.last_seq
+        start = max(after, last_seq - limit, self._dropped)
+        return [format_event(self.get(seq)) for seq in range(start + 1, last_seq + 1)]
+
+    async def wait(self, seq: int) -> None:
+        """Wait for an event after `seq`."""
+        while self.last_seq <= seq:
+            if self._changed is None:
+                self._changed = anyio.Event()
+            await self._changed.wait()
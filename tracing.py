@@ -0,0 +1,176 @@
+"""
+Lightweight tracing: nested spans, propagated through a context variable.
+
+A span without a parent starts a new trace, for example one per HTTP request in TracingMiddleware.
+AnyIO copies the context into the tasks it starts, so spans opened by child tasks nest under the span
+that started them. Every finished span feeds the thanos_span_seconds histogram, and adds its duration to
+the Server-Timing header of its request. With TRACE_EXPORT_DIR set, finished traces are also appended
+to a per-process file in the Chrome trace event format, which Perfetto and chrome://tracing can open.
+They are written every TRACE_EXPORT_INTERVAL by run_trace_exporter, in a worker thread.
+"""
+
+import itertools
+import os
+import re
+import time
+from collections.abc import Generator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass
+from pathlib import Path
+
+import anyio
+import orjson
+from anyio import to_thread
+
+from config import NAME, TRACE_EXPORT_DIR, TRACE_EXPORT_INTERVAL, TRACE_PRINT_THRESHOLD
+from metrics import Histogram
+
+_span_seconds = Histogram('thanos_span_seconds', 'Duration of traced operations.', ('span',))
+
+_trace_ids = itertools.count(1)
+_print_threshold_ns = int(TRACE_PRINT_THRESHOLD.total_seconds() * 1e9)
+_export_path = Path(TRACE_EXPORT_DIR) / f'{NAME}-trace-{os.getpid()}.json' if TRACE_EXPORT_DIR else None
+
+_INVALID_TOKEN_RE = re.compile(r'[^\w.-]')
+
+
+@dataclass(kw_only=True, slots=True)
+class _Trace:
+    id: int
+    timings: dict[str, float]  # summed milliseconds by span name
+    events: list[dict] | None  # finished spans to export
+
+
+@dataclass(kw_only=True, slots=True)
+class Span:
+    name: str
+    trace: _Trace
+    start_ns: int
+    attrs: dict
+
+
+_current_span: ContextVar[Span | None] = ContextVar('current_span', default=None)
+
+# events of the finished traces, not exported yet
+_pending_events: list[dict] = []
+
+
+def _add_timing(trace: _Trace, name: str, duration_ns: int) -> None:
+    trace.timings[name] = trace.timings.get(name, 0) + duration_ns / 1e6
+
+
+def _export(events: list[dict]) -> None:
+    # the JSON array format may be left unterminated, which allows appending
+    with _export_path.open('ab') as f:
+        if not f.tell():
+            f.write(b'[\n')
+
+        f.writelines(orjson.dumps(event) + b',\n' for event in events)
+
+
+@contextmanager
+def span(name: str, **attrs) -> Generator[Span, None, None]:
+    """Trace the enclosed code as `name`, under the current span. Keep names static, put details in `attrs`."""
+    parent = _current_span.get()
+
+    if parent is not None:
+        trace = parent.trace
+    else:
+        trace = _Trace(id=next(_trace_ids), timings={}, events=[] if _export_path is not None else None)
+
+    current = Span(name=name, trace=trace, start_ns=time.perf_counter_ns(), attrs=attrs)
+    token = _current_span.set(current)
+
+    try:
+        yield current
+    finally:
+        _current_span.reset(token)
+        duration_ns = time.perf_counter_ns() - current.start_ns
+        _span_seconds.observe(duration_ns / 1e9, span=name)
+        _add_timing(trace, name, duration_ns)
+
+        if trace.events is not None:
+            trace.events.append(
+                {
+                    'name': name,
+                    'ph': 'X',
+                    'ts': current.start_ns // 1000,
+                    'dur': duration_ns // 1000,
+                    'pid': os.getpid(),
+                    'tid': trace.id,
+                    'args': attrs,
+                }
+            )
+
+            if parent is None:
+                _pending_events.extend(trace.events)
+
+        if duration_ns >= _print_threshold_ns:
+            details = ''.join(f' {key}={value}' for key, value in attrs.items())
+            print(f'[⏱️] {name}{details} took {duration_ns / 1e9:.3f}s')
+
+
+async def run_trace_exporter() -> None:
+    global _pending_events
+
+    if _export_path is None:
+        return
+
+    try:
+        while True:
+            await anyio.sleep(TRACE_EXPORT_INTERVAL.total_seconds())
+
+            if _pending_events:
+                events, _pending_events = _pending_events, []
+                await to_thread.run_sync(_export, events)
+    finally:
+        # on shutdown, the last traces are written right away
+        if _pending_events:
+            events, _pending_events = _pending_events, []
+            _export(events)
+
+
+def detach_trace() -> None:
+    """Detach the current task from the trace it was started in, for long-lived tasks started by a request."""
+    _current_span.set(None)
+
+
+def record_timing(name: str, seconds: float) -> None:
+    """Account for time spent in many small steps, like cursor fetches, without a span for each of them."""
+    _span_seconds.observe(seconds, span=name)
+    current = _current_span.get()
+
+    if current is not None:
+        _add_timing(current.trace, name, int(seconds * 1e9))
+
+
+def _server_timing(trace: _Trace) -> str:
+    return ', '.join(
+        f'{_INVALID_TOKEN_RE.sub("_", name)};dur={duration:.1f}' for name, duration in trace.timings.items()
+    )
+
+
+class TracingMiddleware:
+    """Trace every HTTP request, and send the time spent by span name in the Server-Timing header."""
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        with span('request', method=scope['method'], path=scope['path']) as root:
+
+            async def send_with_timing(message: dict) -> None:
+                if message['type'] == 'http.response.start':
+                    # streamed bodies are produced after the headers: their spans are not included
+                    _add_timing(root.trace, 'total', time.perf_counter_ns() - root.start_ns)
+                    headers = [*message.get('headers', ()), (b'server-timing', _server_timing(root.trace).encode())]
+                    message = {**message, 'headers': headers}
+
+                await send(message)
+
+            await self.app(scope, receive, send_with_timing)
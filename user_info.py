@@ -0,0 +1,126 @@
+"""
+Latest OpenStreetMap user info, cached in two tiers: a per-process LRU in front of a shared Mongo collection.
+
+Entries older than USER_INFO_SOFT_TTL are still returned, but refreshed in the background.
+Entries older than USER_INFO_HARD_TTL are never returned, and Mongo eventually removes them with a TTL index.
+"""
+
+from collections.abc import Iterable, Sequence
+from datetime import datetime
+
+import anyio
+from cachetools import LRUCache
+from pymongo import ReplaceOne
+
+from config import USER_INFO_HARD_TTL, USER_INFO_SOFT_TTL
+from config_db import USER_CACHE_COLLECTION
+from deleted_users import get_deleted_users
+from metrics import Counter, mongo_write_seconds
+from tracing import span
+from user_lookup import user_lookup
+from utils import retry_exponential
+
+# uid -> (user info or None if not found, fetched at)
+_lru: LRUCache[int, tuple[dict | None, datetime]] = LRUCache(maxsize=32 * 1024)
+
+_stale_uids: set[int] = set()
+_stale_event: anyio.Event | None = None
+
+# the cache hit ratio, by where each user was found
+_lookups = Counter('thanos_user_info_lookups_total', 'User info lookups, by source.', ('source',))
+
+
+async def _store(users: dict[int, dict | None]) -> None:
+    if not users:
+        return
+
+    fetched_at = datetime.utcnow()
+
+    for uid, user in users.items():
+        _lru[uid] = (user, fetched_at)
+
+    with mongo_write_seconds.time(operation='user_cache'):
+        await USER_CACHE_COLLECTION.bulk_write(
+            [
+                ReplaceOne({'_id': uid}, {'user': user, 'fetched_at': fetched_at}, upsert=True)
+                for uid, user in users.items()
+            ],
+            ordered=False,
+        )
+
+
+async def get_latest_user_info(uids: Iterable[int]) -> dict[int, dict | None]:
+    """Return the user info of the given users, None for deleted or missing users."""
+    result = {}
+    uids_set = set(uids)
+    now = datetime.utcnow()
+    soft_expired = now - USER_INFO_SOFT_TTL
+    hard_expired = now - USER_INFO_HARD_TTL
+
+    # check for deleted users
+    for uid in await get_deleted_users(uids_set):
+        result[uid] = None
+        uids_set.remove(uid)
+        _lookups.inc(source='deleted')
+
+    def use_cached(uid: int, user: dict | None, fetched_at: datetime) -> None:
+        result[uid] = user
+        uids_set.remove(uid)
+        user_lookup.stats.cache_hits += 1
+
+        if fetched_at < soft_expired:
+            _stale_uids.add(uid)
+
+    # check the process cache
+    for uid in tuple(uids_set):
+        entry = _lru.get(uid)
+        if entry is not None and entry[1] >= hard_expired:
+            use_cached(uid, *entry)
+            _lookups.inc(source='process')
+
+    # check the shared cache
+    if uids_set:
+        cursor = USER_CACHE_COLLECTION.find({'_id': {'$in': tuple(uids_set)}, 'fetched_at': {'$gte': hard_expired}})
+
+        async for doc in cursor:
+            _lru[doc['_id']] = (doc['user'], doc['fetched_at'])
+            use_cached(doc['_id'], doc['user'], doc['fetched_at'])
+            _lookups.inc(source='mongo')
+
+    if _stale_uids and _stale_event is not None:
+        _stale_event.set()
+
+    # only never seen (or hard-expired) users wait for the api
+    if uids_set:
+        with span('fetch_users', users=len(uids_set)):
+            users = await user_lookup.fetch(uids_set)
+
+        print(f'[USERS] Batch size {user_lookup.batch_size}, {user_lookup.stats}')
+
+        await _store(users)
+        result.update(users)
+        _lookups.inc(len(users), source='api')
+
+    return result
+
+
+@retry_exponential(None)
+async def _refresh(uids: Sequence[int]) -> None:
+    await _store(await user_lookup.fetch(uids))
+
+
+async def run_user_info_refresher() -> None:
+    """Refresh soft-expired users in the background, in every worker process."""
+    global _stale_event
+
+    while True:
+        _stale_event = anyio.Event()
+
+        if not _stale_uids:
+            await _stale_event.wait()
+
+        uids = tuple(_stale_uids)
+        _stale_uids.clear()
+
+        with span('refresh_stale_users', users=len(uids)):
+            await _refresh(uids)
@@ -0,0 +1,149 @@
+import time
+from collections.abc import Iterable, Sequence
+from dataclasses import dataclass
+from datetime import timedelta
+from itertools import islice
+
+import anyio
+from cachetools import TTLCache
+from httpx import AsyncClient
+
+from config import USER_INFO_HARD_TTL, USER_LOOKUP_BATCH_SIZE, USER_LOOKUP_CONCURRENCY
+from http_clients import get_api_client
+from metrics import Histogram
+from utils import retry_exponential
+
+_MIN_BATCH_SIZE = 25
+_BATCH_SIZE_STEP = 25
+
+# requests slower than this shrink the batch size
+_TARGET_LATENCY = timedelta(seconds=2)
+
+_request_seconds = Histogram('thanos_user_lookup_request_seconds', 'Duration of users.json requests.')
+
+
+@dataclass(kw_only=True, slots=True)
+class UserLookupStats:
+    requests: int = 0
+    errors: int = 0
+    splits: int = 0
+    cache_hits: int = 0
+    missing_hits: int = 0
+
+
+class UserLookupEngine:
+    """
+    Looks up users on the users.json endpoint, with at most `concurrency` requests in flight.
+
+    Batches are cut lazily by a fixed pool of workers, so that they follow the batch size, which grows
+    additively while requests are fast and halves on slow or failed ones. The API answers 404 if any user
+    of a batch does not exist: the batch is then bisected, and the ids found missing are remembered, so
+    later lookups skip them instead of bisecting again.
+    """
+
+    __slots__ = ('_batch_size', '_concurrency', '_limiter', '_max_batch_size', '_missing', 'stats')
+
+    def __init__(self, *, concurrency: int, max_batch_size: int) -> None:
+        self._concurrency = concurrency
+        self._limiter: anyio.CapacityLimiter | None = None
+        self._max_batch_size = max_batch_size
+        self._batch_size = max_batch_size
+        self._missing: TTLCache[int, bool] = TTLCache(maxsize=64 * 1024, ttl=USER_INFO_HARD_TTL.total_seconds())
+        self.stats = UserLookupStats()
+
+    @property
+    def batch_size(self) -> int:
+        return self._batch_size
+
+    def _adapt(self, elapsed: float | None) -> None:
+        if elapsed is None or elapsed > _TARGET_LATENCY.total_seconds():
+            self._batch_size = max(_MIN_BATCH_SIZE, self._batch_size // 2)
+        else:
+            self._batch_size = min(self._max_batch_size, self._batch_size + _BATCH_SIZE_STEP)
+
+    @retry_exponential(timedelta(seconds=30))
+    async def _request(self, http: AsyncClient, batch: Sequence[int]) -> list[dict] | None:
+        """Return the found users, or None if the API rejected the batch because of a missing user."""
+        if self._limiter is None:
+            self._limiter = anyio.CapacityLimiter(self._concurrency)
+
+        async with self._limiter:
+            ts = time.perf_counter()
+            self.stats.requests += 1
+
+            try:
+                r = await http.get('users.json', params={'users': ','.join(map(str, batch))})
+
+                # at some point, api returned 404 if at least one user is not found
+                if r.status_code == 404:
+                    return None
+
+                r.raise_for_status()
+            except Exception:
+                self.stats.errors += 1
+                self._adapt(None)
+                raise
+
+            elapsed = time.perf_counter() - ts
+            _request_seconds.observe(elapsed)
+            self._adapt(elapsed)
+
+        return [user['user'] for user in r.json()['users']]
+
+    async def fetch(self, uids: Iterable[int]) -> dict[int, dict | None]:
+        """Return the user info of the given users, None for missing users."""
+        result = {}
+        pending = []
+
+        for uid in uids:
+            if uid in self._missing:
+                result[uid] = None
+                self.stats.missing_hits += 1
+            else:
+                pending.append(uid)
+
+        if not pending:
+            return result
+
+        uids_iter = iter(pending)
+        splits: list[Sequence[int]] = []
+
+        async def worker(http: AsyncClient) -> None:
+            while True:
+                if splits:
+                    batch = splits.pop()
+                elif not (batch := tuple(islice(uids_iter, self._batch_size))):
+                    return
+
+                users = await self._request(http, batch)
+
+                if users is None:
+                    if len(batch) == 1:
+                        self._missing[batch[0]] = True
+                        result[batch[0]] = None
+                    else:
+                        self.stats.splits += 1
+                        mid = len(batch) // 2
+                        splits.append(batch[:mid])
+                        splits.append(batch[mid:])
+                    continue
+
+                batch_set = set(batch)
+
+                for user in users:
+                    uid = user['id']
+                    result[uid] = user
+                    batch_set.remove(uid)
+
+                for uid in batch_set:
+                    self._missing[uid] = True
+                    result[uid] = None
+
+        async with anyio.create_task_group() as tg:
+            for _ in range(self._concurrency):
+                tg.start_soon(worker, get_api_client())
+
+        return result
+
+
+user_lookup = UserLookupEngine(concurrency=USER_LOOKUP_CONCURRENCY, max_batch_size=USER_LOOKUP_BATCH_SIZE)
@@ -6,7 +6,8 @@ from fastapi import Depends, HTTPException, Request, status
 from fastapi.websockets import WebSocket
 
 from config import DISABLE_USER_WHITELIST
-from utils import get_http_client, retry_exponential
+from http_clients import get_api_client
+from utils import retry_exponential
 
 _user_cache = TTLCache(maxsize=1024, ttl=7200)  # 2 hours
 
@@ -32,10 +33,9 @@ async def fetch_user_details(request: Request = None, websocket: WebSocket = Non
     except KeyError:
         pass
 
-    async with get_http_client('https://api.openstreetmap.org/api', auth=OAuth2Auth(token)) as http:
-        r = await http.get('/0.6/user/details.json')
-        if not r.is_success:
-            return None
+    r = await get_api_client().get('user/details.json', auth=OAuth2Auth(token))
+    if not r.is_success:
+        return None
 
     try:
         user = r.json()['user']
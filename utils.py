@@ -1,8 +1,6 @@
 import functools
 import random
 import time
-from collections.abc import Generator
-from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 import anyio
@@ -12,22 +10,6 @@ import orjson
 from config import USER_AGENT
 
 
-@contextmanager
-def print_run_time(message: str | list) -> Generator[None, None, None]:
-    start_time = time.perf_counter()
-    try:
-        yield
-    finally:
-        end_time = time.perf_counter()
-        elapsed_time = end_time - start_time
-
-        # support message by reference
-        if isinstance(message, list):
-            message = message[0]
-
-        print(f'[⏱️] {message} took {elapsed_time:.3f}s')
-
-
 def retry_exponential(timeout: timedelta | None, *, start: timedelta = timedelta(seconds=1)):
     timeout_seconds = float('inf') if timeout is None else timeout.total_seconds()
 
@@ -52,18 +34,25 @@ def retry_exponential(timeout: timedelta | None, *, start: timedelta = timedelta
     return decorator
 
 
-def get_http_client(base_url: str = '', *, auth: tuple | None = None, headers: dict | None = None) -> httpx.AsyncClient:
+def get_http_client(
+    base_url: str = '',
+    *,
+    auth: tuple | None = None,
+    headers: dict | None = None,
+    **kwargs,
+) -> httpx.AsyncClient:
     if not headers:
         headers = {}
 
     headers['User-Agent'] = USER_AGENT
+    kwargs.setdefault('timeout', 60)
 
     return httpx.AsyncClient(
         base_url=base_url,
         follow_redirects=True,
-        timeout=60,
         auth=auth,
         headers=headers,
+        **kwargs,
     )
 
 